@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Times the migrations created by django_custom_user_migration against large
+amounts of data.
+
+This follows the same process as the tests, using a copy of the test project,
+but the project is filled with synthetic data first, and each generated
+migration is run on its own, forwards and then backwards. Wall time, peak RSS,
+rows/sec (for the populate and empty migrations, which copy or delete the
+users, otherwise null) and the phases reported by the migration are written to
+a JSON file.
+
+Run from the root of the repository, e.g.:
+
+    ./benchmarks/run_benchmarks.py --users 10000 1000000 10000000
+
+Postgres uses the same database as the tests, and is skipped if it can't be
+connected to.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.test_django_custom_user_migration import (TestProcessPostgres,  # noqa: E402
+                                                     TestProcessSqlite)
+
+# Tables whose rows are copied by the populate migration
+COPIED_TABLES = ["auth_user", "auth_user_groups", "auth_user_user_permissions"]
+
+# Written by the migrations, relative to the test project
+REPORT_FILE = "report.log"
+
+# Runs a single migration. When all the migrations are run together, the
+# post_migrate handlers only run at the end, and the content type of the new
+# model created by them would otherwise clash with the contenttypes migration.
+MIGRATE_SCRIPT = """
+import os, sys
+os.environ['DJANGO_SETTINGS_MODULE'] = 'myapp.settings'
+import django
+django.setup()
+from django.core.management import call_command
+from django.db.models.signals import post_migrate
+post_migrate.receivers = []
+call_command('migrate', *sys.argv[1:], interactive=False)
+"""
+
+
+class Benchmark(object):
+
+    def __init__(self, users, populate_options="", schema_options=""):
+        # The TestCase needs the name of an existing test method
+        super(Benchmark, self).__init__('test_process')
+        self.users = users
+        self.populate_options = populate_options
+        self.schema_options = schema_options
+
+    def run(self):
+        self.setUp()
+        try:
+            return self.run_migrations()
+        finally:
+            self.tearDown()
+
+    def run_migrations(self):
+        self.shell("./manage.py migrate")
+        output = subprocess.check_output(
+            [sys.executable, "manage.py", "myproject_create_benchmark_data",
+             "--users={0}".format(self.users)],
+            cwd="test_project")
+        row_counts = dict((table_name, int(count)) for table_name, count in
+                          (line.split() for line in output.decode('utf-8').splitlines()))
+        rows = sum(row_counts.get(table_name, 0) for table_name in COPIED_TABLES)
+
+        # Create the migrations, as in the tests, recording what each one is
+        self.add_to_installed_apps("django_custom_user_migration")
+        self.set_report(REPORT_FILE)
+        self.create_custom_user_model()
+        self.add_to_installed_apps("accounts")
+        self.shell("./manage.py makemigrations accounts")
+        initial = self.get_migrations()[0]
+        # Django 1.10 and later refuse to make migrations in the new model's
+        # app unless its initial migration has been applied
+        self.migrate(initial)
+        kinds = {}
+        self.create_migration(kinds, "populate",
+                              "./manage.py create_custom_user_populate_migration "
+                              "auth.User accounts.MyUser " + self.populate_options)
+        self.create_migration(kinds, "schema",
+                              "./manage.py create_custom_user_schema_migration "
+                              "auth.User accounts.MyUser " + self.schema_options)
+        self.create_migration(kinds, "contenttypes",
+                              "./manage.py create_custom_user_contenttypes_migration "
+                              "auth.User accounts.MyUser")
+        self.replace_user_import("from django_custom_user_migration.models import AbstractUser",
+                                 "from django.contrib.auth.models import AbstractUser")
+        self.set_auth_user_model("accounts.MyUser")
+        self.create_migration(kinds, "auto", "./manage.py makemigrations accounts")
+        self.create_migration(kinds, "empty",
+                              "./manage.py create_custom_user_empty_migration "
+                              "auth.User accounts.MyUser " + self.populate_options)
+        migrations = self.get_migrations()
+
+        results = []
+        self.migrate(initial)
+        for name in migrations[1:]:
+            results.append(self.time_migration(name, kinds[name], "forwards", name, rows))
+        self.shell("./manage.py migrate --noinput")
+
+        self.set_auth_user_model("auth.User")
+        self.replace_user_import("from django.contrib.auth.models import AbstractUser",
+                                 "from django_custom_user_migration.models import AbstractUser")
+        for previous, name in reversed(list(zip(migrations, migrations[1:]))):
+            results.append(self.time_migration(name, kinds[name], "backwards", previous, rows))
+
+        return {
+            'database': self.database,
+            'users': self.users,
+            'populate_options': self.populate_options,
+            'schema_options': self.schema_options,
+            'row_counts': row_counts,
+            'migrations': results,
+        }
+
+    def get_migrations(self):
+        return sorted(f[:-len(".py")] for f in os.listdir("test_project/accounts/migrations")
+                      if f.endswith(".py") and f != "__init__.py")
+
+    def create_migration(self, kinds, kind, command):
+        existing = self.get_migrations()
+        self.shell(command)
+        for name in self.get_migrations():
+            if name not in existing:
+                kinds[name] = kind
+
+    def migrate(self, target, wait=True):
+        process = subprocess.Popen([sys.executable, "-c", MIGRATE_SCRIPT, "accounts", target],
+                                   cwd="test_project")
+        if wait and process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "migrate accounts " + target)
+        return process
+
+    def time_migration(self, name, kind, direction, target, rows):
+        print("Running {0} migration {1} {2}".format(kind, name, direction))
+        report_path = os.path.join("test_project", REPORT_FILE)
+        report_start = os.path.getsize(report_path) if os.path.exists(report_path) else 0
+        start = time.time()
+        process = self.migrate(target, wait=False)
+        # wait4 gives the resource usage of this process alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.time() - start
+        process.returncode = status
+        if status != 0:
+            raise subprocess.CalledProcessError(status, "migrate accounts " + target)
+        phases = []
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                f.seek(report_start)
+                phases = [json.loads(line) for line in f]
+        return {
+            'name': name,
+            'kind': kind,
+            'direction': direction,
+            'wall_time': wall_time,
+            # Kilobytes on Linux, bytes on Mac OS X
+            'peak_rss': usage.ru_maxrss,
+            # Only the populate and empty migrations process every user row
+            'rows_per_second': rows / wall_time if kind in ["populate", "empty"] else None,
+            # As reported by the migration, see CUSTOM_USER_MIGRATION_REPORT
+            'phases': phases,
+        }
+
+
+class SqliteBenchmark(Benchmark, TestProcessSqlite):
+
+    database = "sqlite"
+
+
+class PostgresBenchmark(Benchmark, TestProcessPostgres):
+
+    database = "postgres"
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import psycopg2
+            psycopg2.connect(database="django_custom_user_migration_tests",
+                             user="django_custom_user_migration_tests",
+                             password="test").close()
+        except Exception as e:
+            print("Skipping postgres: {0}".format(e))
+            return False
+        return True
+
+
+BENCHMARKS = {
+    'sqlite': SqliteBenchmark,
+    'postgres': PostgresBenchmark,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10000],
+                        help="Numbers of users to create. Default 10000.")
+    parser.add_argument("--databases", nargs="+", choices=sorted(BENCHMARKS.keys()),
+                        default=["sqlite", "postgres"])
+    parser.add_argument("--populate-options", default="",
+                        help="Options passed to the populate and empty migration commands.")
+    parser.add_argument("--schema-options", default="",
+                        help="Options passed to the schema migration command.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    results = []
+    for database in args.databases:
+        benchmark_class = BENCHMARKS[database]
+        if hasattr(benchmark_class, 'is_available') and not benchmark_class.is_available():
+            continue
+        for users in args.users:
+            benchmark = benchmark_class(users,
+                                        populate_options=args.populate_options,
+                                        schema_options=args.schema_options)
+            results.append(benchmark.run())
+
+    with open(args.output, "w") as f:
+        json.dump({
+            'created': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print("Results written to {0}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,18 @@ from __future__ import absolute_import, unicode_literals
 import inspect
 
 from django.apps import apps
-from django.core.management.base import BaseCommand
-from django.db import models
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
 from django.db.migrations import Migration
 from django.db.migrations.autodetector import MigrationAutodetector
 from django.db.migrations.loader import MigrationLoader
 from django.db.migrations.state import ProjectState
 from django.db.migrations.writer import MigrationWriter
 
-from django_custom_user_migration.utils import (empty_table, fetch_with_column_names, get_max_id,
-                                                make_table_name, populate_table, reset_sequence)
+from django_custom_user_migration import utils
+from django_custom_user_migration.utils import (copy_table_deferring_indexes,
+                                                copy_table_resumable, find_related_apps,
+                                                run_with_fast_sqlite)
 
 
 class CustomUserCommand(BaseCommand):
@@ -26,29 +28,64 @@ class CustomUserCommand(BaseCommand):
         destination_model = options['destination_model']
         from_app_label, from_model_name = source_model.split(".")
         to_app_label, to_model_name = destination_model.split(".")
+        self.options = options
+        self.loader = None
+        self.leaf_index = None
+        self.autodetector = None
         self.handle_custom_user(from_app_label, from_model_name, to_app_label, to_model_name)
 
-    def create_runpython_migration(self, app_label, forwards_backwards, extra_functions,
-                                   extra_dependencies=None):
+    def get_leaf_index(self):
+        # The migration graph is loaded once per command, and its leaf nodes
+        # are indexed by app, since building a MigrationLoader and scanning
+        # for leaf nodes is slow in projects with many apps.
+        if self.leaf_index is None:
+            self.loader = MigrationLoader(None, ignore_no_migrations=True)
+            self.leaf_index = LeafIndex(self.loader.graph)
+        return self.leaf_index
+
+    def get_last_migration(self, app_label):
+        return self.get_leaf_index().get(app_label)
+
+    def get_model_pairs(self, from_model, to_model):
+        # We need to populate the model table, but also the automatically
+        # created M2M tables from the corresponding table on the source model
+        model_pairs = [((from_model._meta.app_label, from_model.__name__),
+                        (to_model._meta.app_label, to_model.__name__))]
+
+        for from_f in from_model._meta.get_fields(include_hidden=True):
+            if not isinstance(from_f, models.ManyToManyField):
+                continue
+            to_f = to_model._meta.get_field(from_f.name)
+
+            # When auth.User has been swapped out, the f.rel.through attribute
+            # becomes None. So we have to build the name manually.
+            make_name = lambda f: "{0}_{1}".format(f.model.__name__, f.name)
+            model_pairs.append(((from_model._meta.app_label, make_name(from_f)),
+                                (to_model._meta.app_label, make_name(to_f))))
+        return model_pairs
+
+    def create_runpython_migration(self, app_label, forwards_backwards,
+                                   extra_dependencies=None, atomic=True):
 
         # Copy source code, so that we can uninstall this helper app
         # and the migrations still work.
         extra_func_code = "\n\n".join(inspect.getsource(f)
-                                      for f in extra_functions)
+                                      for f in get_copied_functions(forwards_backwards))
 
-        loader = MigrationLoader(None, ignore_no_migrations=True)
-        autodetector = MigrationAutodetector(
-            loader.project_state(),
-            ProjectState.from_apps(apps),
-            None,
-        )
+        leaf_index = self.get_leaf_index()
+        if self.autodetector is None:
+            self.autodetector = MigrationAutodetector(
+                self.loader.project_state(),
+                ProjectState.from_apps(apps),
+                None,
+            )
 
         changes = {
             app_label: [Migration("custom", app_label)]
         }
-        changes = autodetector.arrange_for_graph(
+        changes = self.autodetector.arrange_for_graph(
             changes=changes,
-            graph=loader.graph,
+            graph=leaf_index,
         )
 
         for app_label, app_migrations in changes.items():
@@ -70,21 +107,249 @@ class CustomUserCommand(BaseCommand):
                     "operations = [",
                     "operations = [\n"
                     "        migrations.RunPython(forwards, backwards),")
+
+                if not atomic:
+                    # Only respected by Django 1.10 and later
+                    migration_string = migration_string.replace(
+                        "class Migration(migrations.Migration):\n",
+                        "class Migration(migrations.Migration):\n\n"
+                        "    atomic = False\n")
                 with open(writer.path, "wb") as fh:
                     fh.write(migration_string.encode('utf-8'))
+                # Later migrations created by this command depend on this one
+                leaf_index.add(app_label, migration.name)
+
+    def create_schema_migration(self, from_app_label, from_model_name,
+                                to_app_label, to_model_name, low_lock=False, fast_sqlite=False,
+                                workers=1):
+        kwargs = {}
+        if low_lock:
+            kwargs['low_lock'] = True
+        if fast_sqlite:
+            kwargs['run'] = run_with_fast_sqlite
+        if workers > 1:
+            kwargs['workers'] = workers
+        forwards_backwards = """
+def forwards(apps, schema_editor):
+    change_foreign_keys(apps, schema_editor,
+                        "{from_app}", "{from_model}",
+                        "{to_app}", "{to_model}"{kwargs})
+
+
+def backwards(apps, schema_editor):
+    change_foreign_keys(apps, schema_editor,
+                        "{to_app}", "{to_model}",
+                        "{from_app}", "{from_model}"{kwargs})
+""".format(
+            from_app=from_app_label,
+            from_model=from_model_name,
+            to_app=to_app_label,
+            to_model=to_model_name,
+            kwargs=format_kwargs(kwargs),
+        )
+
+        FromModel = apps.get_model(from_app_label, from_model_name)
+
+        # Need to ensure we depend on all related apps, otherwise the migration
+        # code which find related tables won't find them all.
+        extra_dependencies = [(app, self.get_last_migration(app))
+                              for app in find_related_apps(FromModel)]
+        # With low_lock, each step needs to be committed separately to
+        # avoid holding locks until the end of the migration, SQLite
+        # PRAGMAs can only be changed outside a transaction, and parallel
+        # workers commit each table independently.
+        self.create_runpython_migration(to_app_label, forwards_backwards,
+                                        extra_dependencies=extra_dependencies,
+                                        atomic=not (low_lock or fast_sqlite or workers > 1))
+
+    def create_contenttypes_migration(self, from_app_label, from_model_name,
+                                      to_app_label, to_model_name):
+        forwards_backwards = """
+def forwards(apps, schema_editor):
+    fix_contenttype(apps, schema_editor,
+                    "{from_app}", "{from_model}",
+                    "{to_app}", "{to_model}")
+
+
+def backwards(apps, schema_editor):
+    fix_contenttype(apps, schema_editor,
+                    "{to_app}", "{to_model}",
+                    "{from_app}", "{from_model}")
+""".format(
+            from_app=from_app_label,
+            from_model=from_model_name,
+            to_app=to_app_label,
+            to_model=to_model_name,
+        )
+        self.create_runpython_migration(to_app_label, forwards_backwards)
+
+
+class LeafIndex(object):
+    """
+    The leaf node of each app in a migration graph. This can be passed in
+    place of the graph to MigrationAutodetector.arrange_for_graph, which only
+    needs the leaf nodes.
+    """
+    def __init__(self, graph):
+        self.leaves = {}
+        # If an app has several leaf nodes, the first is used
+        for app_label, name in graph.leaf_nodes():
+            self.leaves.setdefault(app_label, name)
+
+    def get(self, app_label):
+        return self.leaves.get(app_label)
+
+    def add(self, app_label, name):
+        self.leaves[app_label] = name
+
+    def leaf_nodes(self):
+        return sorted(self.leaves.items())
+
+
+def format_kwargs(kwargs):
+    # Functions are passed by name, so that they are copied into the migration
+    return "".join(", {0}={1}".format(k, v.__name__ if inspect.isfunction(v) else repr(v))
+                   for k, v in sorted(kwargs.items()))
+
+
+def get_copied_functions(code):
+    # Returns the functions from utils that code calls, and the ones that
+    # they call in turn, in the order they are defined.
+    functions = dict((name, f) for name, f in vars(utils).items()
+                     if inspect.isfunction(f) and f.__module__ == utils.__name__)
+
+    def get_callees(code_object):
+        # Includes the names used by nested functions and lambdas
+        names = set(code_object.co_names)
+        for const in code_object.co_consts:
+            if inspect.iscode(const):
+                names.update(f.__name__ for f in get_callees(const))
+        return [functions[name] for name in names if name in functions]
+
+    copied = set()
+    pending = get_callees(compile(code, "<migration>", "exec"))
+    while pending:
+        f = pending.pop()
+        if f not in copied:
+            copied.add(f)
+            pending.extend(get_callees(f.__code__))
+    return sorted(copied, key=lambda f: f.__code__.co_firstlineno)
 
 
 class CustomUserPopulateCommand(CustomUserCommand):
 
+    def add_arguments(self, parser):
+        super(CustomUserPopulateCommand, self).add_arguments(parser)
+        parser.add_argument("--copy-mode", choices=["rows", "server", "copy"], default="rows",
+                            help="How rows are copied between tables. 'rows' fetches rows "
+                            "into Python in batches, 'server' uses a single "
+                            "INSERT ... SELECT statement so rows never leave the database, "
+                            "'copy' streams batches with COPY on PostgreSQL.")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of rows fetched at a time with --copy-mode=rows "
+                            "or --copy-mode=copy.")
+        parser.add_argument("--max-buffer-bytes", type=int, default=8 * 1024 * 1024,
+                            help="Approximate maximum amount of row data held in memory "
+                            "for fetching or inserting with --copy-mode=rows.")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of threads, each with their own database connection, "
+                            "used to copy ranges of rows in parallel. Not used for SQLite.")
+        parser.add_argument("--resumable", action="store_true", default=False,
+                            help="Record the progress of the copy in a table, and commit "
+                            "after each batch, so that an interrupted migration can be "
+                            "resumed by running it again.")
+        parser.add_argument("--online", action="store_true", default=False,
+                            help="Keep the new table in sync with the old one using "
+                            "triggers, and copy existing rows in small committed batches, "
+                            "so that the application can keep running during the copy. "
+                            "Not supported on SQLite.")
+        parser.add_argument("--fast-sqlite", action="store_true", default=False,
+                            help="On SQLite, turn off foreign key checks and use fast but "
+                            "unsafe journalling while copying. Requires Django 1.10 or later.")
+        parser.add_argument("--rename-tables", action="store_true", default=False,
+                            help="On PostgreSQL, move rows to the new tables by swapping "
+                            "table names instead of copying them. Other databases copy "
+                            "rows as usual.")
+        parser.add_argument("--empty-mode", choices=["delete", "truncate", "chunked"],
+                            default="delete",
+                            help="How tables are emptied. 'delete' uses a single DELETE "
+                            "statement, 'truncate' uses TRUNCATE on PostgreSQL and MySQL "
+                            "where it is safe, 'chunked' deletes --batch-size rows at a time "
+                            "and commits after each batch.")
+        parser.add_argument("--vacuum", action="store_true", default=False,
+                            help="Reclaim space with VACUUM after emptying tables on "
+                            "PostgreSQL and SQLite. Requires Django 1.10 or later.")
+        parser.add_argument("--defer-indexes", action="store_true", default=False,
+                            help="Drop the secondary indexes and constraints of each new table "
+                            "while it is populated, rebuild them afterwards and analyze "
+                            "the table.")
+        parser.add_argument("--source-database",
+                            help="Alias of the database holding the old tables, if it isn't "
+                            "the one being migrated.")
+        parser.add_argument("--target-database",
+                            help="Alias of the database holding the new tables, if it isn't "
+                            "the one being migrated.")
+
+    def get_populate_kwargs(self):
+        kwargs = {'copy_mode': str(self.options['copy_mode']),
+                  'batch_size': self.options['batch_size'],
+                  'max_buffer_bytes': self.options['max_buffer_bytes'],
+                  }
+        if self.options['resumable']:
+            kwargs['copy'] = copy_table_resumable
+        if self.options['defer_indexes']:
+            kwargs['copy'] = copy_table_deferring_indexes
+        if self.options['fast_sqlite']:
+            kwargs['run'] = run_with_fast_sqlite
+        return kwargs
+
+    def get_empty_kwargs(self):
+        kwargs = {}
+        if self.options['empty_mode'] != "delete":
+            kwargs['empty_mode'] = str(self.options['empty_mode'])
+        if self.options['empty_mode'] == "chunked":
+            kwargs['batch_size'] = self.options['batch_size']
+        if self.options['vacuum']:
+            kwargs['vacuum'] = True
+        return kwargs
+
     def create_populate_migration(self, from_app_label, from_model_name,
                                   to_app_label, to_model_name, reverse=False):
         populate_template = """
     populate_table(apps, schema_editor,
                    "{from_app}", "{from_model}",
-                   "{to_app}", "{to_model}")"""
+                   "{to_app}", "{to_model}"{kwargs})"""
+        populate_databases_template = """
+    populate_table_between_databases(apps, schema_editor,
+                                     "{from_app}", "{from_model}",
+                                     "{to_app}", "{to_model}"{kwargs})"""
+        populate_parallel_template = """
+    populate_tables_parallel(apps, schema_editor, [{pairs}
+    ]{kwargs})"""
+        pair_template = """
+        ("{from_app}", "{from_model}", "{to_app}", "{to_model}"),"""
+        swap_template = """
+    swap_tables(apps, schema_editor, [{pairs}
+    ]{kwargs})"""
+        unswap_template = """
+    unswap_tables(apps, schema_editor, [{pairs}
+    ]{kwargs})"""
         empty_template = """
     empty_table(apps, schema_editor,
-                "{to_app}", "{to_model}")"""
+                "{to_app}", "{to_model}"{kwargs})"""
+        online_populate_template = """
+    install_sync_triggers(apps, schema_editor,
+                          "{from_app}", "{from_model}",
+                          "{to_app}", "{to_model}")
+    backfill_table(apps, schema_editor,
+                   "{from_app}", "{from_model}",
+                   "{to_app}", "{to_model}"{kwargs})"""
+        remove_template = """
+    remove_sync_triggers(apps, schema_editor,
+                         "{from_app}", "{from_model}",
+                         "{to_app}", "{to_model}")"""
+        reset_template = """
+    reset_sequence(apps, schema_editor, "{app}", "{model}")"""
 
         forwards_backwards_template = """
 def forwards(apps, schema_editor):{forwards}
@@ -98,40 +363,137 @@ def backwards(apps, schema_editor):{backwards}
         if reverse:
             from_model, to_model = to_model, from_model
 
-        # We need to populate the model table, but also the automatically
-        # created M2M tables from the corresponding table on the source model
-        model_pairs = [((from_model._meta.app_label, from_model.__name__),
-                        (to_model._meta.app_label, to_model.__name__))]
-
-        for from_f in from_model._meta.get_fields(include_hidden=True):
-            if not isinstance(from_f, models.ManyToManyField):
-                continue
-            to_f = to_model._meta.get_field(from_f.name)
-
-            # When auth.User has been swapped out, the f.rel.through attribute
-            # becomes None. So we have to build the name manually.
-            make_name = lambda f: "{0}_{1}".format(f.model.__name__, f.name)
-            model_pairs.append(((from_model._meta.app_label, make_name(from_f)),
-                                (to_model._meta.app_label, make_name(to_f))))
+        model_pairs = self.get_model_pairs(from_model, to_model)
 
+        workers = self.options['workers']
+        resumable = self.options['resumable']
+        online = self.options['online']
+        if workers > 1 and resumable:
+            raise CommandError("--workers and --resumable can't be used together")
+        fast_sqlite = self.options['fast_sqlite']
+        if online and (workers > 1 or resumable or fast_sqlite):
+            raise CommandError("--online can't be used with --workers, --resumable "
+                               "or --fast-sqlite")
+        if online and connection.vendor == 'sqlite':
+            # The schema migration rebuilds tables that the triggers refer to
+            raise CommandError("--online is not supported on SQLite")
+        if self.options['defer_indexes'] and (workers > 1 or resumable or online):
+            raise CommandError("--defer-indexes can't be used with --workers, --resumable "
+                               "or --online")
+        rename_tables = self.options['rename_tables']
+        if rename_tables and (workers > 1 or online):
+            raise CommandError("--rename-tables can't be used with --workers or --online")
+        source_database = self.options['source_database']
+        target_database = self.options['target_database']
+        if (source_database or target_database) and (
+                self.options['copy_mode'] != "rows" or workers > 1 or resumable or online or
+                fast_sqlite or self.options['defer_indexes'] or rename_tables):
+            raise CommandError("--source-database and --target-database can only be used "
+                               "with --copy-mode=rows, and can't be used with --workers, "
+                               "--resumable, --online, --fast-sqlite, --defer-indexes "
+                               "or --rename-tables")
+        if reverse:
+            # The empty migration copies rows back from the new tables
+            source_database, target_database = target_database, source_database
+        database_kwargs = {}
+        if source_database:
+            database_kwargs['source_database'] = str(source_database)
+        if target_database:
+            database_kwargs['target_database'] = str(target_database)
+        empty_kwargs = self.get_empty_kwargs()
+        if target_database:
+            empty_kwargs['database'] = str(target_database)
         populate = ""
         empty = ""
-        for ((from_a, from_m), (to_a, to_m)) in model_pairs:
-            populate += populate_template.format(
-                from_app=from_a,
-                from_model=from_m,
-                to_app=to_a,
-                to_model=to_m,
+        if online and not reverse:
+            for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                populate += online_populate_template.format(
+                    from_app=from_a,
+                    from_model=from_m,
+                    to_app=to_a,
+                    to_model=to_m,
+                    kwargs=format_kwargs({'batch_size': self.options['batch_size']}),
+                )
+            for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                populate += reset_template.format(app=to_a, model=to_m)
+        elif rename_tables:
+            populate = swap_template.format(
+                pairs="".join(pair_template.format(from_app=from_a,
+                                                   from_model=from_m,
+                                                   to_app=to_a,
+                                                   to_model=to_m)
+                              for ((from_a, from_m), (to_a, to_m)) in model_pairs),
+                kwargs=format_kwargs(self.get_populate_kwargs()),
+            )
+        elif workers > 1:
+            populate = populate_parallel_template.format(
+                pairs="".join(pair_template.format(from_app=from_a,
+                                                   from_model=from_m,
+                                                   to_app=to_a,
+                                                   to_model=to_m)
+                              for ((from_a, from_m), (to_a, to_m)) in model_pairs),
+                kwargs=format_kwargs(dict(self.get_populate_kwargs(), workers=workers)),
             )
+        elif database_kwargs:
+            for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                populate += populate_databases_template.format(
+                    from_app=from_a,
+                    from_model=from_m,
+                    to_app=to_a,
+                    to_model=to_m,
+                    kwargs=format_kwargs(dict(batch_size=self.options['batch_size'],
+                                              max_buffer_bytes=self.options['max_buffer_bytes'],
+                                              **database_kwargs)),
+                )
+        else:
+            for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                populate += populate_template.format(
+                    from_app=from_a,
+                    from_model=from_m,
+                    to_app=to_a,
+                    to_model=to_m,
+                    kwargs=format_kwargs(self.get_populate_kwargs()),
+                )
+
+        if online:
+            # The triggers always live on the tables of the original user
+            # model, so for the reverse migration the pairs are swapped back.
+            for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                if reverse:
+                    (from_a, from_m), (to_a, to_m) = (to_a, to_m), (from_a, from_m)
+                empty += remove_template.format(
+                    from_app=from_a,
+                    from_model=from_m,
+                    to_app=to_a,
+                    to_model=to_m,
+                )
+            if reverse:
+                # The application has been writing to the old table, so the
+                # new tables' sequences are behind.
+                for ((from_a, from_m), (to_a, to_m)) in model_pairs:
+                    empty += reset_template.format(app=from_a, model=from_m)
 
-        # Empty in reverse order i.e. M2M tables first
-        for ((from_a, from_m), (to_a, to_m)) in reversed(model_pairs):
-            empty += empty_template.format(
-                from_app=from_a,
-                from_model=from_m,
-                to_app=to_a,
-                to_model=to_m,
+        if rename_tables and not reverse:
+            # The new tables hold the only copy of the rows, so they are
+            # swapped back rather than emptied.
+            empty += unswap_template.format(
+                pairs="".join(pair_template.format(from_app=from_a,
+                                                   from_model=from_m,
+                                                   to_app=to_a,
+                                                   to_model=to_m)
+                              for ((from_a, from_m), (to_a, to_m)) in model_pairs),
+                kwargs=format_kwargs(empty_kwargs),
             )
+        else:
+            # Empty in reverse order i.e. M2M tables first
+            for ((from_a, from_m), (to_a, to_m)) in reversed(model_pairs):
+                empty += empty_template.format(
+                    from_app=from_a,
+                    from_model=from_m,
+                    to_app=to_a,
+                    to_model=to_m,
+                    kwargs=format_kwargs(empty_kwargs),
+                )
 
         if not reverse:
             data = {'forwards': populate,
@@ -143,7 +505,9 @@ def backwards(apps, schema_editor):{backwards}
                     }
         forwards_backwards = forwards_backwards_template.format(**data)
 
-        self.create_runpython_migration(to_app_label, forwards_backwards,
-                                        [populate_table, empty_table, make_table_name,
-                                         fetch_with_column_names, get_max_id,
-                                         reset_sequence])
+        # Rows copied by parallel workers, resumable or online copies, and
+        # rows deleted in chunks, are committed independently, and SQLite
+        # PRAGMAs and VACUUM only work outside a transaction.
+        atomic = not (workers > 1 or resumable or online or fast_sqlite or
+                      self.options['empty_mode'] == "chunked" or self.options['vacuum'])
+        self.create_runpython_migration(to_app_label, forwards_backwards, atomic=atomic)
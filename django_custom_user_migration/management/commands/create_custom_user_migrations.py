@@ -0,0 +1,37 @@
+from __future__ import absolute_import, unicode_literals
+
+from .base import CustomUserPopulateCommand
+
+
+class Command(CustomUserPopulateCommand):
+    help = ("Creates the populate, schema, contenttypes and empty migrations in one go, "
+            "loading the migration graph only once.")
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument("--low-lock", action="store_true", default=False,
+                            help="On PostgreSQL, add the new foreign key constraints as "
+                            "NOT VALID and validate them afterwards, so that tables are "
+                            "not locked while existing rows are checked.")
+        # --workers and --fast-sqlite apply to the populate and empty
+        # migrations, so the schema migration has its own.
+        parser.add_argument("--schema-fast-sqlite", action="store_true", default=False,
+                            help="--fast-sqlite for the schema migration.")
+        parser.add_argument("--schema-workers", type=int, default=1,
+                            help="--workers for the schema migration.")
+
+    def handle_custom_user(self, from_app_label, from_model_name,
+                           to_app_label, to_model_name):
+        self.create_populate_migration(from_app_label, from_model_name,
+                                       to_app_label, to_model_name,
+                                       reverse=False)
+        self.create_schema_migration(from_app_label, from_model_name,
+                                     to_app_label, to_model_name,
+                                     low_lock=self.options['low_lock'],
+                                     fast_sqlite=self.options['schema_fast_sqlite'],
+                                     workers=self.options['schema_workers'])
+        self.create_contenttypes_migration(from_app_label, from_model_name,
+                                           to_app_label, to_model_name)
+        self.create_populate_migration(from_app_label, from_model_name,
+                                       to_app_label, to_model_name,
+                                       reverse=True)
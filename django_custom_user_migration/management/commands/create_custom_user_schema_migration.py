@@ -1,40 +1,28 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.apps import apps
-
-from django_custom_user_migration.utils import (change_foreign_keys, find_related_apps,
-                                                get_last_migration)
-
 from .base import CustomUserCommand
 
 
 class Command(CustomUserCommand):
 
-    def handle_custom_user(self, from_app_label, from_model_name, to_app_label, to_model_name):
-        forwards_backwards = """
-def forwards(apps, schema_editor):
-    change_foreign_keys(apps, schema_editor,
-                        "{from_app}", "{from_model}",
-                        "{to_app}", "{to_model}")
-
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument("--low-lock", action="store_true", default=False,
+                            help="On PostgreSQL, add the new foreign key constraints as "
+                            "NOT VALID and validate them afterwards, so that tables are "
+                            "not locked while existing rows are checked.")
+        parser.add_argument("--fast-sqlite", action="store_true", default=False,
+                            help="On SQLite, turn off foreign key checks and use fast but "
+                            "unsafe journalling while rebuilding tables. Requires Django "
+                            "1.10 or later.")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of threads, each with their own database connection, "
+                            "used to alter tables in parallel. Implies --low-lock on "
+                            "PostgreSQL. Not used for SQLite.")
 
-def backwards(apps, schema_editor):
-    change_foreign_keys(apps, schema_editor,
-                        "{to_app}", "{to_model}",
-                        "{from_app}", "{from_model}")
-""".format(
-            from_app=from_app_label,
-            from_model=from_model_name,
-            to_app=to_app_label,
-            to_model=to_model_name,
-        )
-
-        FromModel = apps.get_model(from_app_label, from_model_name)
-
-        # Need to ensure we depend on all related apps, otherwise the migration
-        # code which find related tables won't find them all.
-        extra_dependencies = [(app, get_last_migration(app))
-                              for app in find_related_apps(FromModel)]
-        self.create_runpython_migration(to_app_label, forwards_backwards,
-                                        [change_foreign_keys],
-                                        extra_dependencies=extra_dependencies)
+    def handle_custom_user(self, from_app_label, from_model_name, to_app_label, to_model_name):
+        self.create_schema_migration(from_app_label, from_model_name,
+                                     to_app_label, to_model_name,
+                                     low_lock=self.options['low_lock'],
+                                     fast_sqlite=self.options['fast_sqlite'],
+                                     workers=self.options['workers'])
@@ -0,0 +1,129 @@
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db import connection, transaction
+
+from django_custom_user_migration.utils import (estimate_row_count, find_foreign_keys,
+                                                get_index_count, get_table_size,
+                                                make_table_name, measure_throughput)
+
+from .base import CustomUserCommand
+
+# Strongest lock taken on each table by each kind of step
+LOCKS = {
+    'postgresql': {
+        'copy': "ACCESS SHARE",
+        'rename': "ACCESS EXCLUSIVE",
+        # Dropping the old constraint and renaming the column need an
+        # exclusive lock, which low_lock only holds while they run.
+        'alter': "ACCESS EXCLUSIVE",
+        'alter_low_lock': "ACCESS EXCLUSIVE (brief)",
+        'delete': "ROW EXCLUSIVE",
+        'truncate': "ACCESS EXCLUSIVE",
+    },
+    'mysql': {
+        'copy': "shared row locks",
+        'rename': "exclusive metadata lock",
+        'alter': "exclusive metadata lock",
+        'alter_low_lock': "exclusive metadata lock",
+        'delete': "exclusive row locks",
+        'truncate': "exclusive metadata lock",
+    },
+}
+
+
+class Command(CustomUserCommand):
+    help = ("Lists the tables that the migrations will copy, alter and empty, "
+            "and estimates how long each phase will take.")
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument("--sample-size", type=int, default=10000,
+                            help="Number of rows used to measure the speed of the database.")
+        parser.add_argument("--rename-tables", action="store_true", default=False,
+                            help="Plan for populate migrations created with --rename-tables.")
+        parser.add_argument("--low-lock", action="store_true", default=False,
+                            help="Plan for a schema migration created with --low-lock.")
+        parser.add_argument("--empty-mode", choices=["delete", "truncate", "chunked"],
+                            default="delete",
+                            help="Plan for empty migrations created with this --empty-mode.")
+
+    def handle_custom_user(self, from_app_label, from_model_name, to_app_label, to_model_name):
+        from_model = apps.get_model(from_app_label, from_model_name)
+        to_model = apps.get_model(to_app_label, to_model_name)
+        locks = LOCKS.get(connection.vendor, {})
+        rename_tables = self.options['rename_tables'] and connection.vendor == 'postgresql'
+        empty_mode = "truncate" if self.options['empty_mode'] == "truncate" else "delete"
+
+        with connection.schema_editor() as schema_editor:
+            model_pairs = self.get_model_pairs(from_model, to_model)
+            copy_table_names = [make_table_name(apps, from_a, from_m)
+                                for ((from_a, from_m), (to_a, to_m)) in model_pairs]
+            changes, skipped = find_foreign_keys(from_model, to_model,
+                                                 from_model_name, to_model_name)
+            alter_table_names = list(OrderedDict(
+                (fk_field.model._meta.db_table, None)
+                for fk_field, old_field, new_field in changes))
+
+            steps = []
+            for table_name in copy_table_names:
+                steps.append(("copy", table_name,
+                              "rename" if rename_tables else "copy"))
+            for table_name in alter_table_names:
+                steps.append(("alter", table_name,
+                              "alter_low_lock" if self.options['low_lock'] else "alter"))
+            for table_name in reversed(copy_table_names):
+                steps.append(("empty", table_name, empty_mode))
+
+            rows = dict((table_name, estimate_row_count(schema_editor, table_name))
+                        for table_name in set(copy_table_names + alter_table_names))
+            if connection.features.can_rollback_ddl:
+                # Undo anything left behind by measuring
+                with transaction.atomic():
+                    rates = measure_throughput(schema_editor, copy_table_names[0],
+                                               self.options['sample_size'])
+                    transaction.set_rollback(True)
+            else:
+                # Nothing can be rolled back, but measure_throughput only
+                # writes to a temporary table, which it drops
+                rates = measure_throughput(schema_editor, copy_table_names[0],
+                                           self.options['sample_size'])
+
+            self.stdout.write("{0:<8} {1:<40} {2:>12} {3:>10} {4:>8}  {5}".format(
+                "Phase", "Table", "Rows", "Size", "Indexes", "Lock"))
+            durations = OrderedDict((phase, 0) for phase in ["copy", "alter", "empty"])
+            for phase, table_name, kind in steps:
+                size = get_table_size(schema_editor, table_name)
+                self.stdout.write("{0:<8} {1:<40} {2:>12} {3:>10} {4:>8}  {5}".format(
+                    phase, table_name, rows[table_name],
+                    "?" if size is None else "{0:.1f}MB".format(size / 1024.0 / 1024.0),
+                    get_index_count(schema_editor, table_name),
+                    locks.get(kind, "database write lock")))
+                duration = self.estimate_duration(kind, rows[table_name], rates)
+                if duration is None or durations[phase] is None:
+                    durations[phase] = None
+                else:
+                    durations[phase] += duration
+
+        self.stdout.write("")
+        self.stdout.write("Measured rows/sec: {0}".format(
+            ", ".join("{0} {1:.0f}".format(name, rate)
+                      for name, rate in sorted(rates.items())) if rates else "no rows to sample"))
+        for phase, duration in durations.items():
+            self.stdout.write("Estimated {0} time: {1}".format(
+                phase, "?" if duration is None else "{0:.1f}s".format(duration)))
+
+    def estimate_duration(self, kind, rows, rates):
+        if rates is None:
+            return None
+        if kind in ["rename", "truncate"]:
+            return 0
+        if kind == "alter" and connection.vendor == 'sqlite':
+            # SQLite copies the whole table to alter it
+            return rows / rates['copy']
+        if kind in ["alter", "alter_low_lock"]:
+            # Existing rows are checked against the new table
+            return rows / rates['scan']
+        return rows / rates[kind]
@@ -0,0 +1,50 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import apps
+from django.core.management.base import CommandError
+from django.db import connection
+
+from django_custom_user_migration.utils import compare_tables, make_table_name
+
+from .base import CustomUserCommand
+
+
+class Command(CustomUserCommand):
+    help = ("Checks that the populate migration copied every row of the old tables "
+            "into the new ones, by comparing hashes of chunks of rows.")
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument("--chunk-size", type=int, default=100000,
+                            help="Number of ids in each chunk whose hashes are compared. "
+                            "Chunks that differ are split into smaller chunks.")
+        parser.add_argument("--max-differences", type=int, default=100,
+                            help="Stop looking for differing rows in a table after "
+                            "finding this many.")
+
+    def handle_custom_user(self, from_app_label, from_model_name, to_app_label, to_model_name):
+        if not 0 < self.options['chunk_size'] < 2 ** 23:
+            raise CommandError("--chunk-size must be between 1 and {0}".format(2 ** 23 - 1))
+        from_model = apps.get_model(from_app_label, from_model_name)
+        to_model = apps.get_model(to_app_label, to_model_name)
+
+        failed = []
+        with connection.schema_editor() as schema_editor:
+            for (from_app, from_m), (to_app, to_m) in self.get_model_pairs(from_model, to_model):
+                from_table_name = make_table_name(apps, from_app, from_m)
+                to_table_name = make_table_name(apps, to_app, to_m)
+                rows, differences = compare_tables(
+                    schema_editor, from_table_name, to_table_name, from_m, to_m,
+                    chunk_size=self.options['chunk_size'],
+                    max_differences=self.options['max_differences'])
+                self.stdout.write("Checked {0} rows of {1} against {2}".format(
+                    rows, from_table_name, to_table_name))
+                for kind, ids in sorted(differences.items()):
+                    if ids:
+                        self.stdout.write("  {0} ids: {1}".format(
+                            kind, ", ".join(str(row_id) for row_id in ids)))
+                if any(differences.values()):
+                    failed.append(to_table_name)
+
+        if failed:
+            raise CommandError("Rows differ in {0}".format(", ".join(failed)))
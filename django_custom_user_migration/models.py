@@ -1,5 +1,6 @@
 from django.contrib import auth
-from django.contrib.auth.models import (AbstractBaseUser, Group, Permission, UserManager,
+from django.contrib.auth.models import UserManager as DjangoUserManager
+from django.contrib.auth.models import (AbstractBaseUser, Group, Permission,
                                         _user_get_all_permissions, _user_has_module_perms,
                                         _user_has_perm)
 from django.core import validators
@@ -16,6 +17,102 @@ from django.utils.translation import ugettext_lazy as _
 # This is a lot of cut-and-paste, with changes marked 'CHANGED!'
 
 
+def prefetch_permissions(users):
+    """
+    Loads the user and group permissions of a list of users in a constant
+    number of queries, and stores them where ModelBackend caches them, so that
+    checking the permissions of these users doesn't hit the database.
+    """
+    # CHANGED! This and UserQuerySet/UserManager are not in Django.
+    users = [user for user in users if user.is_active and not hasattr(user, '_perm_cache')]
+    if not users:
+        return
+    model = users[0].__class__
+    using = users[0]._state.db
+    user_perms = dict((user.pk, set()) for user in users)
+    group_perms = dict((user.pk, set()) for user in users)
+
+    superusers = [user for user in users if user.is_superuser]
+    if superusers:
+        # As for ModelBackend, superusers have every permission
+        all_perms = set("%s.%s" % (ct, name) for ct, name in
+                        Permission.objects.using(using)
+                        .values_list('content_type__app_label', 'codename').order_by())
+        for user in superusers:
+            user_perms[user.pk] = set(all_perms)
+            group_perms[user.pk] = set(all_perms)
+
+    user_ids = [user.pk for user in users if not user.is_superuser]
+    if user_ids:
+        field = model._meta.get_field('user_permissions')
+        for user_id, ct, name in (
+                model.user_permissions.through.objects.using(using)
+                .filter(**{field.m2m_field_name() + '__in': user_ids})
+                .values_list(field.m2m_field_name(),
+                             field.m2m_reverse_field_name() + '__content_type__app_label',
+                             field.m2m_reverse_field_name() + '__codename')):
+            user_perms[user_id].add("%s.%s" % (ct, name))
+
+        field = model._meta.get_field('groups')
+        user_groups = list(model.groups.through.objects.using(using)
+                           .filter(**{field.m2m_field_name() + '__in': user_ids})
+                           .values_list(field.m2m_field_name(), field.m2m_reverse_field_name()))
+        perms_by_group = {}
+        if user_groups:
+            for group_id, ct, name in (
+                    Group.permissions.through.objects.using(using)
+                    .filter(group__in=set(group_id for user_id, group_id in user_groups))
+                    .values_list('group', 'permission__content_type__app_label',
+                                 'permission__codename')):
+                perms_by_group.setdefault(group_id, set()).add("%s.%s" % (ct, name))
+        for user_id, group_id in user_groups:
+            group_perms[user_id].update(perms_by_group.get(group_id, ()))
+
+    for user in users:
+        user._user_perm_cache = user_perms[user.pk]
+        user._group_perm_cache = group_perms[user.pk]
+        user._perm_cache = user_perms[user.pk] | group_perms[user.pk]
+
+
+class UserQuerySet(models.QuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super(UserQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_permissions = False
+        self._permissions_prefetched = False
+
+    def prefetch_permissions(self):
+        """
+        Returns a new QuerySet that loads the permissions of all the users
+        in it when it is evaluated. See prefetch_permissions().
+        """
+        clone = self._clone()
+        clone._prefetch_permissions = True
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super(UserQuerySet, self)._clone(**kwargs)
+        clone._prefetch_permissions = self._prefetch_permissions
+        return clone
+
+    def _fetch_all(self):
+        super(UserQuerySet, self)._fetch_all()
+        if self._prefetch_permissions and not self._permissions_prefetched:
+            prefetch_permissions([obj for obj in self._result_cache
+                                  if isinstance(obj, self.model)])
+            self._permissions_prefetched = True
+
+
+class UserManager(DjangoUserManager.from_queryset(UserQuerySet)):
+
+    def deconstruct(self):
+        # Migrations refer to Django's UserManager, so that they don't change
+        # when switching to django.contrib.auth.models.AbstractUser.
+        as_manager, manager_class, qs_class, args, kwargs = \
+            super(UserManager, self).deconstruct()
+        return as_manager, 'django.contrib.auth.models.UserManager', qs_class, args, kwargs
+
+
 class PermissionsMixin(models.Model):
     """
     A mixin class that adds the fields and methods necessary to support
@@ -67,6 +164,35 @@ class PermissionsMixin(models.Model):
     def get_all_permissions(self, obj=None):
         return _user_get_all_permissions(self, obj)
 
+    # CHANGED! The permission checks below are answered from a cache of all
+    # the permissions the user has, loaded once per instance.
+
+    def get_permission_cache(self):
+        """
+        Returns a frozenset of all the permission strings this user has,
+        loading it from the auth backends the first time it is needed. Returns
+        None if a backend can't list its permissions, in which case the
+        backends have to be asked about each permission.
+        """
+        if not hasattr(self, '_permission_cache'):
+            backends = auth.get_backends()
+            if all(hasattr(backend, "get_all_permissions") for backend in backends):
+                self._permission_cache = frozenset(self.get_all_permissions())
+            else:
+                self._permission_cache = None
+        return self._permission_cache
+
+    def clear_permission_cache(self):
+        """
+        Clears the cached permissions of this user, including those cached by
+        ModelBackend. This must be called after changing the groups or
+        permissions of the user (or of their groups) for the change to be seen
+        by this instance.
+        """
+        for name in ['_permission_cache', '_perm_cache', '_user_perm_cache', '_group_perm_cache']:
+            if hasattr(self, name):
+                delattr(self, name)
+
     def has_perm(self, perm, obj=None):
         """
         Returns True if the user has the specified permission. This method
@@ -80,6 +206,11 @@ class PermissionsMixin(models.Model):
         if self.is_active and self.is_superuser:
             return True
 
+        if obj is None:
+            permissions = self.get_permission_cache()
+            if permissions is not None:
+                return perm in permissions
+
         # Otherwise we need to check the backends.
         return _user_has_perm(self, perm, obj)
 
@@ -103,6 +234,10 @@ class PermissionsMixin(models.Model):
         if self.is_active and self.is_superuser:
             return True
 
+        permissions = self.get_permission_cache()
+        if permissions is not None:
+            return any(perm[:perm.index('.')] == app_label for perm in permissions)
+
         return _user_has_module_perms(self, app_label)
 
 
@@ -14,16 +14,6 @@ def find_related_apps(model):
     return list(sorted(set([m._meta.app_label for m in related_models])))
 
 
-def get_last_migration(app_label):
-    from django.db.migrations.loader import MigrationLoader
-    loader = MigrationLoader(None, ignore_no_migrations=True)
-    graph = loader.graph
-    leaf_nodes = graph.leaf_nodes()
-    for leaf in leaf_nodes:
-        if leaf[0] == app_label:
-            return leaf[1]
-
-
 def make_table_name(apps, app, model):
     try:
         m = apps.get_model(app, model)
@@ -41,58 +31,1514 @@ def fetch_with_column_names(schema_editor, sql, params):
     return rows, [r[0] for r in c.description]
 
 
-def populate_table(apps, schema_editor, from_app, from_model, to_app, to_model):
+def get_column_names(schema_editor, table_name):
+    ops = schema_editor.connection.ops
+    return fetch_with_column_names(
+        schema_editor,
+        "SELECT * FROM {0} WHERE 1 = 0;".format(ops.quote_name(table_name)),
+        [])[1]
+
+
+def fk_column_name(model):
+    # Column that an auto-created M2M table uses to point to the model
+    # e.g. 'User_groups' -> 'user_id'
+    return "{0}_id".format(model.split("_")[0]).lower()
+
+
+def map_column_names(from_model, to_model, cols):
+    # The column names in the new table aren't necessarily the same
+    # as in the old table - things like 'user_id' vs 'myuser_id'.
+    # We have to map them, and this seems to be good enough for our needs:
+    map_fk_col = (lambda c: fk_column_name(to_model)
+                  if c == fk_column_name(from_model)
+                  else c)
+    return list(map(map_fk_col, cols))
+
+
+def populate_table(apps, schema_editor, from_app, from_model, to_app, to_model,
+                   copy_mode="rows", batch_size=1000, max_buffer_bytes=8 * 1024 * 1024,
+                   copy=None, run=None):
     # Due to swapped out models, which means that some model classes (and/or
     # their auto-created M2M tables) do not exist or don't function correctly,
     # it is better to use SELECT / INSERT than attempting to use ORM.
-    import math
+    #
+    # copy is the function that copies the rows, which takes the same
+    # arguments as copy_table (the default), e.g. copy_table_resumable. If run
+    # is given, the copy is done by calling run(schema_editor, func), e.g.
+    # run_with_fast_sqlite, which calls func(editor). These are passed in by
+    # the migration, rather than chosen here, so that only the functions it
+    # uses are copied into it.
+    from_table_name = make_table_name(apps, from_app, from_model)
+    to_table_name = make_table_name(apps, to_app, to_model)
+    progress = make_progress(schema_editor, from_table_name, to_table_name)
+    copy = copy or copy_table
+
+    def populate(editor):
+        copy(editor, from_table_name, to_table_name, from_model, to_model,
+             copy_mode, batch_size, max_buffer_bytes, progress=progress)
+
+    def populate_and_reset():
+        if run is not None:
+            run(schema_editor, populate)
+        else:
+            populate(schema_editor)
+        reset_sequence(apps, schema_editor, to_app, to_model)
+
+    record_phase(schema_editor, "populate", to_table_name, populate_and_reset)
 
+
+def populate_table_between_databases(apps, schema_editor, from_app, from_model, to_app, to_model,
+                                     batch_size=1000, max_buffer_bytes=8 * 1024 * 1024,
+                                     source_database=None, target_database=None):
+    # Like populate_table, where source_database and target_database are
+    # aliases of the databases that hold the old and new tables, if they
+    # aren't the one being migrated.
     from_table_name = make_table_name(apps, from_app, from_model)
     to_table_name = make_table_name(apps, to_app, to_model)
+    source_editor = get_database_editor(schema_editor, source_database)
+    target_editor = get_database_editor(schema_editor, target_database)
+    progress = make_progress(source_editor, from_table_name, to_table_name)
+    other_editors = [editor for editor in [source_editor, target_editor]
+                     if editor is not schema_editor]
+
+    def copy_between_databases():
+        for editor in other_editors:
+            record_statements(editor.connection, get_phase_records(schema_editor.connection))
+        try:
+            copy_table_between_databases(source_editor, target_editor,
+                                         from_table_name, to_table_name, from_model, to_model,
+                                         batch_size, max_buffer_bytes, progress=progress)
+            reset_sequence(apps, target_editor, to_app, to_model)
+        finally:
+            for editor in other_editors:
+                record_statements(editor.connection, [])
+
+    record_phase(schema_editor, "populate", to_table_name, copy_between_databases)
+
+
+def get_database_editor(schema_editor, database):
+    # Returns a schema editor for the database alias, which is schema_editor
+    # itself if database is None or the database being migrated. Otherwise,
+    # like the editors used by run_with_commits, it isn't entered, so each
+    # statement is committed unless a transaction is started.
+    from django.db import connections
+    if database is None or database == schema_editor.connection.alias:
+        return schema_editor
+    return connections[database].schema_editor()
+
+
+def copy_table_between_databases(source_editor, target_editor, from_table_name, to_table_name,
+                                 from_model, to_model, batch_size, max_buffer_bytes,
+                                 progress=None, queue_size=4):
+    # Copies the rows of from_table_name in the source database into
+    # to_table_name in the target database. Rows are read in batches of
+    # batch_size rows, or about max_buffer_bytes of data if that is reached
+    # first, by a separate thread with its own connection, and handed
+    # over through a queue holding at most queue_size batches, so that
+    # reading and inserting overlap while memory use stays bounded. The rows
+    # are inserted in a single transaction on the target database.
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    from django.db import connections, transaction
+
+    source_alias = source_editor.connection.alias
+    old_cols = get_column_names(source_editor, from_table_name)
+    new_cols = map_column_names(from_model, to_model, old_cols)
+    batches = queue.Queue(maxsize=queue_size)
+    finished = object()
+    stopped = threading.Event()
+    errors = []
+
+    def put(item):
+        # Gives up if the inserting side has stopped taking batches
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        # Django connections are per thread, so this is a new connection.
+        connection = connections[source_alias]
+        record_statements(connection, get_phase_records(source_editor.connection))
+        try:
+            batch = []
+            batch_bytes = 0
+            for row in iter_rows(connection.schema_editor(), from_table_name,
+                                 old_cols.index("id"), batch_size,
+                                 max_buffer_bytes=max_buffer_bytes):
+                batch.append(row)
+                batch_bytes += estimate_row_bytes(row)
+                if len(batch) >= batch_size or batch_bytes >= max_buffer_bytes:
+                    put(batch)
+                    batch = []
+                    batch_bytes = 0
+                if stopped.is_set():
+                    return
+            if batch:
+                put(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(finished)
+            record_statements(connection, [])
+            connection.close()
+
+    def rows():
+        while True:
+            batch = batches.get()
+            if batch is finished:
+                return
+            for row in batch:
+                yield row
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        with transaction.atomic(using=target_editor.connection.alias):
+            insert_rows(target_editor, to_table_name, new_cols, rows(), max_buffer_bytes,
+                        progress=progress)
+            if errors:
+                raise errors[0]
+    finally:
+        stopped.set()
+        reader.join()
+
+
+def run_with_commits(schema_editor, func):
+    # Calls func(editor), where editor is a schema editor whose connection can
+    # commit. Django < 1.10 ignores Migration.atomic, and runs migrations
+    # inside a transaction on databases that support transactional DDL, so in
+    # that case a separate connection is used. SQLite only allows one writer
+    # at a time, so there we have to stay in the migration's transaction.
+    if (schema_editor.connection.in_atomic_block and
+            schema_editor.connection.vendor != 'sqlite'):
+        errors = run_in_threads(schema_editor, [None],
+                                lambda connection, task: func(connection.schema_editor()),
+                                1)
+        if errors:
+            raise errors[0][1]
+    else:
+        func(schema_editor)
+
+
+def run_with_fast_sqlite(schema_editor, func):
+    # Calls func(schema_editor). On SQLite, foreign key checks are turned
+    # off, and the journal is kept in memory without syncing to disk, which
+    # makes large copies and table rebuilds much faster, at the cost of
+    # possible corruption if the process crashes. The previous settings are
+    # restored afterwards. These PRAGMAs can't be changed inside a
+    # transaction, so nothing is changed if the migration is atomic.
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        func(schema_editor)
+        return
+    pragmas = ["foreign_keys", "journal_mode", "synchronous"]
+    with connection.cursor() as cursor:
+        old_values = []
+        for pragma in pragmas:
+            cursor.execute("PRAGMA {0};".format(pragma))
+            old_values.append(cursor.fetchone()[0])
+        for pragma, value in zip(pragmas, ["OFF", "MEMORY", "OFF"]):
+            cursor.execute("PRAGMA {0} = {1};".format(pragma, value))
+    try:
+        func(schema_editor)
+    finally:
+        with connection.cursor() as cursor:
+            for pragma, value in zip(pragmas, old_values):
+                cursor.execute("PRAGMA {0} = {1};".format(pragma, value))
+
+
+def run_with_deferred_indexes(schema_editor, table_name, func):
+    # Calls func(schema_editor) to fill table_name, with the secondary
+    # indexes and constraints of the table removed, and then rebuilds each of
+    # them in a single pass, which is much faster than updating them for every
+    # row. The primary key is kept, since other tables point to it. If func
+    # fails, the migration's transaction is rolled back, restoring them. On
+    # MySQL, the checks are turned off for the session instead, and turned
+    # back on even if func fails. Finally, the table is analyzed, so that the
+    # query planner knows it is full.
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    rebuild = []
+    restore = []
+    if connection.vendor == 'postgresql':
+        schema_editor.execute("SET CONSTRAINTS ALL DEFERRED;")
+        indexes = fetch_with_column_names(
+            schema_editor,
+            "SELECT i.relname, pg_get_indexdef(x.indexrelid) FROM pg_index x "
+            "JOIN pg_class i ON i.oid = x.indexrelid "
+            "WHERE x.indrelid = %s::regclass AND NOT x.indisprimary AND NOT EXISTS "
+            "(SELECT 1 FROM pg_constraint c "
+            "WHERE c.conrelid = x.indrelid AND c.conindid = x.indexrelid);",
+            [qn(table_name)])[0]
+        for index_name, definition in indexes:
+            schema_editor.execute("DROP INDEX {0};".format(qn(index_name)))
+            rebuild.append(definition + ";")
+        # Unique constraints before FKs
+        constraints = fetch_with_column_names(
+            schema_editor,
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('u', 'f') ORDER BY contype DESC;",
+            [qn(table_name)])[0]
+        for constraint_name, definition in constraints:
+            schema_editor.execute("ALTER TABLE {0} DROP CONSTRAINT {1};".format(
+                qn(table_name), qn(constraint_name)))
+            rebuild.append("ALTER TABLE {0} ADD CONSTRAINT {1} {2};".format(
+                qn(table_name), qn(constraint_name), definition))
+        rebuild.append("ANALYZE {0};".format(qn(table_name)))
+    elif connection.vendor == 'sqlite':
+        # Indexes for UNIQUE constraints have no SQL and can't be dropped
+        indexes = fetch_with_column_names(
+            schema_editor,
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL;",
+            [table_name])[0]
+        for index_name, definition in indexes:
+            schema_editor.execute("DROP INDEX {0};".format(qn(index_name)))
+            rebuild.append(definition + ";")
+        rebuild.append("ANALYZE {0};".format(qn(table_name)))
+    elif connection.vendor == 'mysql':
+        schema_editor.execute("SET unique_checks = 0;")
+        schema_editor.execute("SET foreign_key_checks = 0;")
+        restore.extend(["SET unique_checks = 1;",
+                        "SET foreign_key_checks = 1;"])
+        rebuild.append("ANALYZE TABLE {0};".format(qn(table_name)))
+    try:
+        func(schema_editor)
+    finally:
+        for statement in restore:
+            schema_editor.execute(statement)
+    for statement in rebuild:
+        schema_editor.execute(statement)
+
+
+def copy_table(schema_editor, from_table_name, to_table_name, from_model, to_model,
+               copy_mode, batch_size, max_buffer_bytes, where=None, progress=None):
+    # copy_mode is one of:
+    #  - "rows": rows are streamed through Python, fetching batch_size rows
+    #    at a time and buffering at most max_buffer_bytes for inserting.
+    #  - "server": a single INSERT ... SELECT statement, so that the data
+    #    never leaves the database server.
+    #  - "copy": on PostgreSQL, batches of rows are streamed with COPY TO/FROM.
+    #    Other databases use "rows" instead.
+    #
+    # where is an optional SQL condition restricting the rows copied. It is
+    # interpolated directly (COPY doesn't support parameters), so must not
+    # contain user input.
+    #
+    # progress is an optional function from make_progress, which is called
+    # with the number of rows copied by each batch.
+    if copy_mode not in ("rows", "server", "copy"):
+        raise ValueError("Unknown copy_mode {0!r}".format(copy_mode))
+
+    ops = schema_editor.connection.ops
+
+    if copy_mode == "server":
+        old_cols = get_column_names(schema_editor, from_table_name)
+        new_cols = map_column_names(from_model, to_model, old_cols)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {3}{4};".format(
+                ops.quote_name(to_table_name),
+                ", ".join(ops.quote_name(col_name) for col_name in new_cols),
+                ", ".join(ops.quote_name(col_name) for col_name in old_cols),
+                ops.quote_name(from_table_name),
+                "" if where is None else " WHERE " + where))
+            if progress is not None:
+                progress(cursor.rowcount)
+        return
+
+    if copy_mode == "copy" and schema_editor.connection.vendor == 'postgresql':
+        old_cols = get_column_names(schema_editor, from_table_name)
+        new_cols = map_column_names(from_model, to_model, old_cols)
+        copy_table_postgresql(schema_editor, from_table_name, to_table_name,
+                              old_cols, new_cols, batch_size, where=where, progress=progress)
+        return
+
+    # Stream rows from the old table straight into the new one, so that
+    # neither side holds the entire table in memory.
+    old_cols = get_column_names(schema_editor, from_table_name)
+    new_cols = map_column_names(from_model, to_model, old_cols)
+    rows = iter_rows(schema_editor, from_table_name, old_cols.index("id"), batch_size,
+                     where=where, max_buffer_bytes=max_buffer_bytes)
+    insert_rows(schema_editor, to_table_name, new_cols, rows, max_buffer_bytes,
+                progress=progress)
+
+
+def iter_rows(schema_editor, table_name, id_index, batch_size, where=None,
+              max_buffer_bytes=None):
+    # Generates the rows of table_name in id order, optionally restricted by
+    # the SQL condition where, fetching batch_size rows at a time. With
+    # max_buffer_bytes, fewer rows are fetched at a time if the rows seen so
+    # far are large enough that batch_size of them would hold more data.
+    connection = schema_editor.connection
+    ops = connection.ops
+    seen = [0, 0]  # rows, bytes
+
+    def get_fetch_size():
+        if max_buffer_bytes is None:
+            return batch_size
+        if not seen[0]:
+            # The first fetch is small, to measure the rows
+            return min(batch_size, 100)
+        return max(1, min(batch_size, max_buffer_bytes * seen[0] // max(1, seen[1])))
+
+    def count(rows):
+        seen[0] += len(rows)
+        seen[1] += sum(estimate_row_bytes(row) for row in rows)
+
+    if connection.vendor == 'postgresql':
+        # A named cursor keeps the result set on the server. Outside of a
+        # transaction it has to be declared WITH HOLD.
+        import uuid
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(
+            name="custom_user_migration_{0}".format(uuid.uuid4().hex),
+            withhold=connection.get_autocommit())
+        try:
+            cursor.execute("SELECT * FROM {0} {1}ORDER BY id;".format(
+                ops.quote_name(table_name),
+                "" if where is None else "WHERE {0} ".format(where)))
+            while True:
+                rows = cursor.fetchmany(get_fetch_size())
+                if not rows:
+                    break
+                count(rows)
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+        return
+
+    # Elsewhere, use keyset pagination, so that the number of queries depends
+    # on the number of rows, not on how sparse the ids are. Some drivers hold
+    # the whole result of a query in memory, so the LIMIT bounds that too.
+    last_id = None
+    while True:
+        conditions = [] if where is None else [where]
+        params = []
+        if last_id is not None:
+            conditions.append("id > %s")
+            params.append(last_id)
+        limit = get_fetch_size()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT * FROM {0} {1}ORDER BY id LIMIT {2};".format(
+                ops.quote_name(table_name),
+                "WHERE {0} ".format(" AND ".join(conditions)) if conditions else "",
+                int(limit)), params)
+            fetched = 0
+            while True:
+                rows = cursor.fetchmany(min(limit, 100))
+                if not rows:
+                    break
+                count(rows)
+                fetched += len(rows)
+                last_id = rows[-1][id_index]
+                for row in rows:
+                    yield row
+        if fetched < limit:
+            break
+
+
+def estimate_row_bytes(row):
+    # Roughly how much data row holds
+    return sum(len(value) if hasattr(value, '__len__') else 8 for value in row)
+
+
+def insert_rows(schema_editor, table_name, cols, rows, max_buffer_bytes, progress=None):
+    import itertools
+
+    # Inserts rows from the iterable rows into table_name. As many rows are
+    # inserted per statement as the backend allows, but no more than about
+    # max_buffer_bytes of data is held at a time. A cursor is used rather than
+    # schema_editor.execute, which formats all the parameters for its debug
+    # log even when logging is off.
+    rows_per_insert = max(1, get_max_query_params(schema_editor) // len(cols))
+    # The SQL only depends on the number of rows, so we build it once per size
+    insert_sql = {}
+    buffered = []
+    buffered_bytes = 0
+    with schema_editor.connection.cursor() as cursor:
+        for row in itertools.chain(rows, [None]):
+            if row is not None:
+                buffered.append(row)
+                buffered_bytes += estimate_row_bytes(row)
+            if buffered and (row is None or
+                             len(buffered) >= rows_per_insert or
+                             buffered_bytes >= max_buffer_bytes):
+                if len(buffered) not in insert_sql:
+                    insert_sql[len(buffered)] = make_insert_sql(schema_editor, table_name,
+                                                                cols, len(buffered))
+                cursor.execute(insert_sql[len(buffered)],
+                               [value for buffered_row in buffered for value in buffered_row])
+                if progress is not None:
+                    progress(len(buffered))
+                buffered = []
+                buffered_bytes = 0
+
+
+def populate_tables_parallel(apps, schema_editor, model_pairs, workers=4,
+                             copy_mode="rows", batch_size=1000,
+                             max_buffer_bytes=8 * 1024 * 1024, run=None):
+    # model_pairs is a list of (from_app, from_model, to_app, to_model), with
+    # the main model first, followed by its auto-created M2M tables. run is
+    # used as by populate_table when the tables are copied one at a time.
+    #
+    # The id space of the main table is split into ranges, which are copied
+    # by a pool of threads, each with its own database connection. Each range
+    # is copied in a single transaction, along with the M2M rows that point
+    # to it, so that FK constraints are satisfied when the transaction
+    # commits. Rows committed by the workers are not rolled back if the
+    # migration fails.
+    tables = [(make_table_name(apps, from_app, from_model),
+               make_table_name(apps, to_app, to_model),
+               from_model, to_model)
+              for from_app, from_model, to_app, to_model in model_pairs]
+
+    progresses = [make_progress(schema_editor, from_table_name, to_table_name)
+                  for from_table_name, to_table_name, from_model, to_model in tables]
+
+    def populate():
+        if workers <= 1 or schema_editor.connection.vendor == 'sqlite':
+            # SQLite only allows one writer at a time, so there is nothing to gain.
+            def copy_tables(editor):
+                for i, (from_table_name, to_table_name, from_model, to_model) in enumerate(tables):
+                    copy_table(editor, from_table_name, to_table_name, from_model, to_model,
+                               copy_mode, batch_size, max_buffer_bytes, progress=progresses[i])
+            if run is not None:
+                run(schema_editor, copy_tables)
+            else:
+                copy_tables(schema_editor)
+        else:
+            ops = schema_editor.connection.ops
+            min_id, max_id = fetch_with_column_names(
+                schema_editor,
+                "SELECT MIN(id), MAX(id) FROM {0};".format(ops.quote_name(tables[0][0])),
+                [])[0][0]
+            tasks = []
+            if min_id is not None:
+                num_ranges = workers * 4
+                width = max(1, (max_id - min_id + num_ranges) // num_ranges)
+                for lower in range(min_id - 1, max_id, width):
+                    tasks.append((lower, lower + width))
+
+            def copy_range(connection, task):
+                lower, upper = task
+                with connection.schema_editor() as worker_editor:
+                    for i, (from_table_name, to_table_name,
+                            from_model, to_model) in enumerate(tables):
+                        column = ops.quote_name("id" if i == 0 else fk_column_name(from_model))
+                        copy_table(worker_editor, from_table_name, to_table_name,
+                                   from_model, to_model, copy_mode, batch_size, max_buffer_bytes,
+                                   where="{0} > {1} AND {0} <= {2}".format(
+                                       column, int(lower), int(upper)),
+                                   progress=progresses[i])
+
+            errors = run_in_threads(schema_editor, tasks, copy_range, workers)
+            if errors:
+                raise errors[0][1]
+
+        for from_app, from_model, to_app, to_model in model_pairs:
+            reset_sequence(apps, schema_editor, to_app, to_model)
+        for from_table_name, to_table_name, from_model, to_model in tables:
+            check_row_counts(schema_editor, from_table_name, to_table_name)
+
+    record_phase(schema_editor, "populate", tables[0][1], populate)
+
+
+def run_in_threads(schema_editor, tasks, func, workers, stop_on_error=True):
+    # Calls func(connection, task) for each task, using a pool of threads that
+    # each have their own connection to the database, so that they commit
+    # independently of the migration's transaction. Returns a list of
+    # (task, exception) for the tasks that failed.
+    import collections
+    import threading
+
+    from django.db import connections
+
+    alias = schema_editor.connection.alias
+    records = get_phase_records(schema_editor.connection)
+    queue = collections.deque(tasks)
+    errors = []
+
+    def worker():
+        # Django connections are per thread, so this is a new connection.
+        # Its statements count towards the phases being recorded.
+        connection = connections[alias]
+        record_statements(connection, records)
+        try:
+            while queue and not (stop_on_error and errors):
+                try:
+                    task = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    func(connection, task)
+                except Exception as e:
+                    errors.append((task, e))
+        finally:
+            record_statements(connection, [])
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(tasks)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def copy_table_resumable(schema_editor, from_table_name, to_table_name, from_model, to_model,
+                         copy_mode, batch_size, max_buffer_bytes, progress=None):
+    # Copies batches of rows, each in a transaction which also records the
+    # last id copied in the progress table, so that if the copy is
+    # interrupted it can carry on where it left off.
+    from django.db import transaction
+
+    def copy_batches(editor):
+        ensure_progress_table(editor)
+        last_id = get_checkpoint(editor, from_table_name, to_table_name)
+        while True:
+            upper = get_batch_upper_id(editor, from_table_name, last_id, batch_size)
+            if upper is None:
+                break
+            where = "id <= {0}".format(int(upper))
+            if last_id is not None:
+                where = "id > {0} AND {1}".format(int(last_id), where)
+            with transaction.atomic(using=editor.connection.alias):
+                copy_table(editor, from_table_name, to_table_name, from_model, to_model,
+                           copy_mode, batch_size, max_buffer_bytes, where=where,
+                           progress=progress)
+                set_checkpoint(editor, from_table_name, to_table_name, upper)
+            last_id = upper
+
+    # Checkpoints are only useful if they are committed
+    run_with_commits(schema_editor, copy_batches)
+
+
+def copy_table_deferring_indexes(schema_editor, from_table_name, to_table_name, *args,
+                                 **kwargs):
+    # Like copy_table, which is passed the arguments, with the secondary
+    # indexes of to_table_name deferred by run_with_deferred_indexes.
+    run_with_deferred_indexes(schema_editor, to_table_name, lambda editor: copy_table(
+        editor, from_table_name, to_table_name, *args, **kwargs))
+
+
+def get_batch_upper_id(schema_editor, table_name, last_id, batch_size):
+    # Returns the largest id in the next batch_size rows after last_id,
+    # or None if there are no more rows.
+    ops = schema_editor.connection.ops
+    where_sql, params = ("", []) if last_id is None else ("WHERE id > %s ", [last_id])
+    return fetch_with_column_names(
+        schema_editor,
+        "SELECT MAX(id) FROM (SELECT id FROM {0} {1}ORDER BY id LIMIT {2}) batch;".format(
+            ops.quote_name(table_name), where_sql, int(batch_size)),
+        params)[0][0][0]
+
+
+def ensure_progress_table(schema_editor):
+    # 191 characters keeps the primary key within MySQL's index size limits
+    schema_editor.execute(
+        "CREATE TABLE IF NOT EXISTS custom_user_migration_progress ("
+        "source_table VARCHAR(191) NOT NULL, "
+        "target_table VARCHAR(191) NOT NULL, "
+        "last_id BIGINT NOT NULL, "
+        "PRIMARY KEY (source_table, target_table));")
+
+
+def get_checkpoint(schema_editor, source_table, target_table):
+    rows = fetch_with_column_names(
+        schema_editor,
+        "SELECT last_id FROM custom_user_migration_progress "
+        "WHERE source_table = %s AND target_table = %s;",
+        [source_table, target_table])[0]
+    return rows[0][0] if rows else None
+
+
+def set_checkpoint(schema_editor, source_table, target_table, last_id):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("UPDATE custom_user_migration_progress SET last_id = %s "
+                       "WHERE source_table = %s AND target_table = %s;",
+                       [last_id, source_table, target_table])
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO custom_user_migration_progress "
+                           "(source_table, target_table, last_id) VALUES (%s, %s, %s);",
+                           [source_table, target_table, last_id])
+
+
+def make_progress(schema_editor, from_table_name, to_table_name, total=None):
+    # Returns a function to be called with the number of rows copied by each
+    # batch, which reports progress to the callable named by the
+    # CUSTOM_USER_MIGRATION_PROGRESS_CALLBACK setting, or log_progress. It
+    # may be called from several threads. total is the number of rows
+    # expected, if it isn't the number of rows in from_table_name.
+    import threading
+    import time
+
+    from django.conf import settings
+    from django.utils.module_loading import import_string
+
+    callback_path = getattr(settings, 'CUSTOM_USER_MIGRATION_PROGRESS_CALLBACK', None)
+    callback = log_progress if callback_path is None else import_string(callback_path)
+    if total is None:
+        total = estimate_row_count(schema_editor, from_table_name)
+    start = time.time()
+    lock = threading.Lock()
+    copied = [0]
+
+    def progress(rows):
+        with lock:
+            copied[0] += rows
+            elapsed = time.time() - start
+            callback(table_name=to_table_name,
+                     rows_copied=copied[0],
+                     rows_remaining=max(total - copied[0], 0),
+                     elapsed=elapsed,
+                     rows_per_second=copied[0] / elapsed if elapsed > 0 else None)
+    return progress
+
+
+def log_progress(table_name, rows_copied, rows_remaining, elapsed, rows_per_second):
+    import logging
+    logging.getLogger('django_custom_user_migration').info(
+        "%s: %d rows copied, about %d remaining, %.1fs elapsed, %s rows/sec",
+        table_name, rows_copied, rows_remaining, elapsed,
+        "?" if rows_per_second is None else "{0:.0f}".format(rows_per_second))
+
+
+def record_phase(schema_editor, phase, table_name, func, **details):
+    # Calls func() and records its wall time, the number of SQL statements it
+    # runs and the rows they insert, update or delete, and on PostgreSQL,
+    # roughly how long its connections wait for locks, by polling pg_locks
+    # from another connection. Statements run by threads started with
+    # run_in_threads are included. Phases can be nested, e.g. one per table
+    # within a step of a migration, and when an outermost phase finishes it
+    # is written out by report_phase. Any details are added to the record.
+    # Returns the result of func().
+    import threading
+    import time
+
+    from django.db import connections
+
+    connection = schema_editor.connection
+    parents = get_phase_records(connection)
+    record = {
+        'phase': phase,
+        'table_name': table_name,
+        'wall_time': 0,
+        'statements': 0,
+        'rows': 0,
+        'lock_wait': 0 if connection.vendor == 'postgresql' else None,
+        'error': None,
+        'steps': [],
+        '_pids': set(),
+    }
+    record.update(details)
+    if parents:
+        root = parents[-1]['_root']
+        parents[-1]['steps'].append(record)
+    else:
+        root = record
+        record['_lock'] = threading.Lock()
+        record['_active'] = []
+    record['_root'] = root
+    with root['_lock']:
+        root['_active'].append(record)
+
+    stopped = threading.Event()
+    sampler = None
+    if root is record and connection.vendor == 'postgresql':
+        alias = connection.alias
+
+        def sample(interval=0.1):
+            # Django connections are per thread, so this is a new connection,
+            # which isn't blocked by the migration's locks.
+            sample_connection = connections[alias]
+            try:
+                last = time.time()
+                while not stopped.wait(interval):
+                    with sample_connection.cursor() as cursor:
+                        cursor.execute("SELECT pid FROM pg_locks WHERE NOT granted;")
+                        waiting = set(row[0] for row in cursor.fetchall())
+                    now = time.time()
+                    with root['_lock']:
+                        for active in root['_active']:
+                            if active['_pids'] & waiting:
+                                active['lock_wait'] += now - last
+                    last = now
+            finally:
+                sample_connection.close()
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+
+    record_statements(connection, parents + [record])
+    start = time.time()
+    try:
+        return func()
+    except Exception as e:
+        record['error'] = "{0}: {1}".format(e.__class__.__name__, e)
+        raise
+    finally:
+        record['wall_time'] = time.time() - start
+        record_statements(connection, parents)
+        with root['_lock']:
+            root['_active'].remove(record)
+        if sampler is not None:
+            stopped.set()
+            sampler.join()
+        if root is record:
+            report_phase(record)
+
+
+def get_phase_records(connection):
+    # Returns the records of the phases that statements run through
+    # connection are counted towards, innermost last.
+    return getattr(connection, 'custom_user_migration_records', [])
+
+
+def record_statements(connection, records):
+    # Counts the statements run through connection, and the rows they affect,
+    # towards each of the phase records in records, instead of those it was
+    # counted towards before. Counting stops if records is empty.
+    if not records:
+        for name in ['custom_user_migration_records', 'make_cursor', 'make_debug_cursor']:
+            connection.__dict__.pop(name, None)
+        return
+    connection.custom_user_migration_records = list(records)
+    if 'make_cursor' in connection.__dict__:
+        return
+
+    class CountingCursor(object):
+        def __init__(self, cursor):
+            self.cursor = cursor
+
+        def __getattr__(self, attr):
+            return getattr(self.cursor, attr)
+
+        def __iter__(self):
+            return iter(self.cursor)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return self.cursor.__exit__(*exc_info)
+
+        def execute(self, sql, params=None):
+            return self.count(sql, self.cursor.execute, sql, params)
+
+        def executemany(self, sql, param_list):
+            return self.count(sql, self.cursor.executemany, sql, param_list)
+
+        def copy_expert(self, sql, *args, **kwargs):
+            return self.count(sql, self.cursor.copy_expert, sql, *args, **kwargs)
+
+        def count(self, sql, func, *args, **kwargs):
+            records = get_phase_records(connection)
+            if not records:
+                return func(*args, **kwargs)
+            lock = records[0]['_root']['_lock']
+            if connection.vendor == 'postgresql':
+                # Recorded first, so that waits for locks during the
+                # statement are noticed.
+                pid = connection.connection.get_backend_pid()
+                with lock:
+                    for record in records:
+                        record['_pids'].add(pid)
+            result = func(*args, **kwargs)
+            rows = 0
+            if (sql.lstrip()[:6].upper() in ['INSERT', 'UPDATE', 'DELETE'] or
+                    sql.rstrip().upper().endswith("FROM STDIN")):
+                rows = max(self.cursor.rowcount, 0)
+            with lock:
+                for record in records:
+                    record['statements'] += 1
+                    record['rows'] += rows
+            return result
+
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: CountingCursor(make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: CountingCursor(make_debug_cursor(cursor))
+
 
-    max_id = get_max_id(schema_editor, from_table_name)
+def report_phase(record):
+    # Appends the record of a finished phase, as a line of JSON, to the file
+    # named by the CUSTOM_USER_MIGRATION_REPORT setting, if there is one, and
+    # writes a summary of it to stdout.
+    import json
+    import sys
 
-    # Use batches to avoid loading entire table into memory
-    BATCH_SIZE = 100
+    from django.conf import settings
 
-    # Careful with off-by-one errors where max_id is a multiple of BATCH_SIZE
-    for batch_num in range(0, int(math.floor(max_id / BATCH_SIZE)) + 1):
-        start = batch_num * BATCH_SIZE
-        stop = start + BATCH_SIZE
-        ops = schema_editor.connection.ops
-        old_rows, old_cols = fetch_with_column_names(
+    def public(record):
+        return dict((key, [public(step) for step in value] if key == 'steps' else value)
+                    for key, value in record.items() if not key.startswith('_'))
+
+    report_path = getattr(settings, 'CUSTOM_USER_MIGRATION_REPORT', None)
+    if report_path is not None:
+        with open(report_path, "a") as f:
+            f.write(json.dumps(public(record), sort_keys=True) + "\n")
+
+    standard_keys = ['phase', 'table_name', 'wall_time', 'statements', 'rows', 'lock_wait',
+                     'error', 'steps']
+
+    def summarize(record, indent):
+        lines = ["{0}{1} {2}: {3:.2f}s, {4} statements, {5} rows{6}{7}{8}".format(
+            "  " * indent, record['phase'], record['table_name'], record['wall_time'],
+            record['statements'], record['rows'],
+            "" if record['lock_wait'] is None else
+            ", {0:.2f}s waiting for locks".format(record['lock_wait']),
+            "".join(", {0} {1}".format(key.replace("_", " "), value)
+                    for key, value in sorted(public(record).items())
+                    if key not in standard_keys),
+            "" if record['error'] is None else ", failed with " + record['error'])]
+        for step in record['steps']:
+            lines.extend(summarize(step, indent + 1))
+        return lines
+    sys.stdout.write("\n  " + "\n  ".join(summarize(record, 0)) + "\n")
+
+
+def estimate_row_count(schema_editor, table_name):
+    # Uses the database's statistics where possible, since counting rows can
+    # take a long time for big tables.
+    connection = schema_editor.connection
+    estimate = None
+    if connection.vendor == 'postgresql':
+        estimate = fetch_with_column_names(
+            schema_editor,
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass;",
+            [connection.ops.quote_name(table_name)])[0][0][0]
+    elif connection.vendor == 'mysql':
+        rows = fetch_with_column_names(
             schema_editor,
-            "SELECT * FROM {0} WHERE id >= %s AND id < %s;".format(
-                ops.quote_name(from_table_name)),
-            [start, stop])
-
-        # The column names in the new table aren't necessarily the same
-        # as in the old table - things like 'user_id' vs 'myuser_id'.
-        # We have to map them, and this seems to be good enough for our needs:
-        base_from_model = from_model.split("_")[0]
-        base_to_model = to_model.split("_")[0]
-        map_fk_col = (lambda c: "{0}_id".format(base_to_model).lower()
-                      if c == "{0}_id".format(base_from_model).lower()
-                      else c)
-        new_cols = list(map(map_fk_col, old_cols))
-
-        for row in old_rows:
-            values_sql = ", ".join(["%s"] * len(new_cols))
-            columns_sql = ", ".join(ops.quote_name(col_name) for col_name in new_cols)
-            sql = "INSERT INTO {0} ({1}) VALUES ({2});".format(ops.quote_name(to_table_name),
-                                                               columns_sql,
-                                                               values_sql)
-
-            # could collect and do 'executemany', but sqlite doesn't let us
-            # execute more than one statement at once it seems.
-            schema_editor.execute(sql, row)
-    reset_sequence(apps, schema_editor, to_app, to_model)
-
-
-def empty_table(apps, schema_editor, from_app, from_model):
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s;",
+            [table_name])[0]
+        estimate = rows[0][0] if rows else None
+    if estimate is None or estimate <= 0:
+        # No statistics, e.g. table hasn't been analyzed.
+        estimate = fetch_with_column_names(
+            schema_editor,
+            "SELECT COUNT(*) FROM {0};".format(connection.ops.quote_name(table_name)),
+            [])[0][0][0]
+    return estimate
+
+
+def install_sync_triggers(apps, schema_editor, from_app, from_model, to_app, to_model):
+    # Installs triggers which copy inserts, updates and deletes on the old
+    # table to the new table, so that they stay in sync while the new table
+    # is populated by backfill_table. The triggers are committed straight
+    # away, so that the application doesn't wait on the migration.
+    #
+    # Not supported on SQLite, which rebuilds tables for most schema changes,
+    # breaking triggers that refer to them.
+    vendor = schema_editor.connection.vendor
+    from_table_name = make_table_name(apps, from_app, from_model)
+    to_table_name = make_table_name(apps, to_app, to_model)
+    qn = schema_editor.connection.ops.quote_name
+    old_cols = get_column_names(schema_editor, from_table_name)
+    new_cols = map_column_names(from_model, to_model, old_cols)
+    params = {
+        'from': qn(from_table_name),
+        'to': qn(to_table_name),
+        'columns': ", ".join(qn(col_name) for col_name in new_cols),
+        'values': ", ".join("NEW.{0}".format(qn(col_name)) for col_name in old_cols),
+        'assignments': ", ".join("{0} = NEW.{1}".format(qn(new_col), qn(old_col))
+                                 for old_col, new_col in zip(old_cols, new_cols)),
+        'function': qn(get_sync_trigger_name(schema_editor, from_table_name, "fn")),
+        'trigger': qn(get_sync_trigger_name(schema_editor, from_table_name, "trg")),
+        'insert_trigger': qn(get_sync_trigger_name(schema_editor, from_table_name, "ins")),
+        'update_trigger': qn(get_sync_trigger_name(schema_editor, from_table_name, "upd")),
+        'delete_trigger': qn(get_sync_trigger_name(schema_editor, from_table_name, "del")),
+    }
+    if vendor == 'postgresql':
+        statements = [
+            "CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ BEGIN "
+            "IF TG_OP = 'DELETE' THEN DELETE FROM {to} WHERE id = OLD.id; RETURN OLD; END IF; "
+            "UPDATE {to} SET {assignments} WHERE id = NEW.id; "
+            "IF NOT FOUND THEN INSERT INTO {to} ({columns}) VALUES ({values}); END IF; "
+            "RETURN NEW; END; $$ LANGUAGE plpgsql;",
+            "DROP TRIGGER IF EXISTS {trigger} ON {from};",
+            "CREATE TRIGGER {trigger} AFTER INSERT OR UPDATE OR DELETE ON {from} "
+            "FOR EACH ROW EXECUTE PROCEDURE {function}();",
+        ]
+    elif vendor == 'mysql':
+        params['assignments'] = ", ".join("{0} = VALUES({0})".format(qn(col_name))
+                                          for col_name in new_cols)
+        upsert = ("INSERT INTO {to} ({columns}) VALUES ({values}) "
+                  "ON DUPLICATE KEY UPDATE {assignments}")
+        statements = [
+            "DROP TRIGGER IF EXISTS {insert_trigger};",
+            "DROP TRIGGER IF EXISTS {update_trigger};",
+            "DROP TRIGGER IF EXISTS {delete_trigger};",
+            "CREATE TRIGGER {insert_trigger} AFTER INSERT ON {from} FOR EACH ROW " + upsert,
+            "CREATE TRIGGER {update_trigger} AFTER UPDATE ON {from} FOR EACH ROW " + upsert,
+            "CREATE TRIGGER {delete_trigger} AFTER DELETE ON {from} FOR EACH ROW "
+            "DELETE FROM {to} WHERE id = OLD.id",
+        ]
+    else:
+        raise NotImplementedError("Sync triggers are not supported for {0}".format(vendor))
+
+    def install(editor):
+        for statement in statements:
+            editor.execute(statement.format(**params))
+    run_with_commits(schema_editor, install)
+
+
+def remove_sync_triggers(apps, schema_editor, from_app, from_model, to_app, to_model):
+    from_table_name = make_table_name(apps, from_app, from_model)
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.connection.ops.quote_name
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP TRIGGER IF EXISTS {0} ON {1};".format(
+            qn(get_sync_trigger_name(schema_editor, from_table_name, "trg")),
+            qn(from_table_name)))
+        schema_editor.execute("DROP FUNCTION IF EXISTS {0}();".format(
+            qn(get_sync_trigger_name(schema_editor, from_table_name, "fn"))))
+    elif vendor == 'mysql':
+        for suffix in ["ins", "upd", "del"]:
+            schema_editor.execute("DROP TRIGGER IF EXISTS {0};".format(
+                qn(get_sync_trigger_name(schema_editor, from_table_name, suffix))))
+
+
+def get_sync_trigger_name(schema_editor, table_name, suffix):
+    from django.db.backends.utils import truncate_name
+    return truncate_name("{0}_sync_{1}".format(table_name, suffix),
+                         schema_editor.connection.ops.max_name_length())
+
+
+def backfill_table(apps, schema_editor, from_app, from_model, to_app, to_model,
+                   batch_size=1000):
+    # Copies rows that are not already in the new table, for use with the
+    # triggers from install_sync_triggers while the application is running.
+    # Each batch is committed separately, and locks the rows it is copying,
+    # so that the triggers can't update or delete them in the new table
+    # before they have been copied. It can safely be run again.
+    from django.db import transaction
+
     from_table_name = make_table_name(apps, from_app, from_model)
+    to_table_name = make_table_name(apps, to_app, to_model)
+    vendor = schema_editor.connection.vendor
+    qn = schema_editor.connection.ops.quote_name
+    old_cols = get_column_names(schema_editor, from_table_name)
+    new_cols = map_column_names(from_model, to_model, old_cols)
+    progress = make_progress(schema_editor, from_table_name, to_table_name)
+
+    if vendor == 'sqlite':
+        template = ("INSERT OR IGNORE INTO {to} ({new_cols}) SELECT {old_cols} FROM {from} "
+                    "WHERE {where};")
+    elif vendor == 'mysql':
+        template = ("INSERT IGNORE INTO {to} ({new_cols}) SELECT {old_cols} FROM {from} "
+                    "WHERE {where} LOCK IN SHARE MODE;")
+    else:
+        template = ("INSERT INTO {to} ({new_cols}) SELECT {old_cols} FROM {from} "
+                    "WHERE {where} AND NOT EXISTS "
+                    "(SELECT 1 FROM {to} new_table WHERE new_table.id = {from}.id) "
+                    "FOR SHARE OF {from};")
+
+    def backfill(editor):
+        last_id = None
+        while True:
+            upper = get_batch_upper_id(editor, from_table_name, last_id, batch_size)
+            if upper is None:
+                break
+            where = "{0}.id <= {1}".format(qn(from_table_name), int(upper))
+            if last_id is not None:
+                where = "{0}.id > {1} AND {2}".format(qn(from_table_name), int(last_id), where)
+            with transaction.atomic(using=editor.connection.alias):
+                with editor.connection.cursor() as cursor:
+                    cursor.execute(template.format(**{
+                        'from': qn(from_table_name),
+                        'to': qn(to_table_name),
+                        'new_cols': ", ".join(qn(col_name) for col_name in new_cols),
+                        'old_cols': ", ".join("{0}.{1}".format(qn(from_table_name), qn(col_name))
+                                              for col_name in old_cols),
+                        'where': where,
+                    }))
+                    progress(cursor.rowcount)
+            last_id = upper
+    record_phase(schema_editor, "populate", to_table_name,
+                 lambda: run_with_commits(schema_editor, backfill))
+
+
+def swap_tables(apps, schema_editor, model_pairs, **kwargs):
+    # model_pairs is a list of (from_app, from_model, to_app, to_model), with
+    # the main model first, followed by its auto-created M2M tables.
+    #
+    # Moves the rows of the 'from' tables into the empty 'to' tables without
+    # copying them, by swapping the names of the tables, and of the
+    # sequences, constraints, indexes and M2M columns that belong to them.
+    # This takes the same time however many rows there are. FKs from other
+    # tables refer to the tables themselves rather than their names, so they
+    # follow the rows. This needs PostgreSQL, other databases fall back to
+    # populate_table, which is passed kwargs.
+    if schema_editor.connection.vendor != 'postgresql':
+        for from_app, from_model, to_app, to_model in model_pairs:
+            populate_table(apps, schema_editor, from_app, from_model, to_app, to_model,
+                           **kwargs)
+        return
+
+    record_phase(schema_editor, "populate",
+                 make_table_name(apps, model_pairs[0][2], model_pairs[0][3]),
+                 lambda: swap_table_names(apps, schema_editor, model_pairs))
+
+
+def unswap_tables(apps, schema_editor, model_pairs, **kwargs):
+    # Reverses swap_tables(apps, schema_editor, model_pairs). On PostgreSQL,
+    # if the 'from' tables are empty, the rows are still in the 'to' tables,
+    # so the tables are swapped back. Otherwise the rows were copied (on
+    # other databases), or have already been moved back by reversing the
+    # empty migration, so the 'to' tables are emptied by empty_table, which
+    # is passed kwargs.
+    qn = schema_editor.connection.ops.quote_name
+    if schema_editor.connection.vendor == 'postgresql' and not any(
+            fetch_with_column_names(schema_editor, "SELECT 1 FROM {0} LIMIT 1;".format(
+                qn(make_table_name(apps, from_app, from_model))), [])[0]
+            for from_app, from_model, to_app, to_model in model_pairs):
+        swap_tables(apps, schema_editor,
+                    [(to_app, to_model, from_app, from_model)
+                     for from_app, from_model, to_app, to_model in model_pairs])
+        return
+    # Empty in reverse order i.e. M2M tables first
+    for from_app, from_model, to_app, to_model in reversed(model_pairs):
+        empty_table(apps, schema_editor, to_app, to_model, **kwargs)
+
+
+def swap_table_names(apps, schema_editor, model_pairs):
+    # Does the work of swap_tables on PostgreSQL
+    import re
+    from django.db.backends.utils import truncate_name
+
+    qn = schema_editor.connection.ops.quote_name
+    max_length = schema_editor.connection.ops.max_name_length()
+    table_pairs = [(make_table_name(apps, from_app, from_model),
+                    make_table_name(apps, to_app, to_model))
+                   for from_app, from_model, to_app, to_model in model_pairs]
+    for (from_table_name, to_table_name), (from_app, from_model, to_app, to_model) in zip(
+            table_pairs, model_pairs):
+        if fetch_with_column_names(
+                schema_editor, "SELECT 1 FROM {0} LIMIT 1;".format(qn(to_table_name)), [])[0]:
+            raise RuntimeError("Can't swap {0} with {1}, because {1} is not empty".format(
+                from_table_name, to_table_name))
+        # The rows are used as they are, so the columns must match, as they
+        # would be mapped when copying.
+        from_columns = sorted(map_column_names(from_model, to_model,
+                                               get_column_names(schema_editor, from_table_name)))
+        to_columns = sorted(get_column_names(schema_editor, to_table_name))
+        if from_columns != to_columns:
+            raise RuntimeError("Can't swap {0} with {1}, because their columns differ: "
+                               "{2} and {3}".format(from_table_name, to_table_name,
+                                                    ", ".join(from_columns),
+                                                    ", ".join(to_columns)))
+
+    # Things that are named after the table
+    queries = [
+        ("SEQUENCE", "SELECT s.relname FROM pg_class s "
+         "JOIN pg_depend d ON d.objid = s.oid "
+         "WHERE s.relkind = 'S' AND d.refobjid = %s::regclass;"),
+        ("CONSTRAINT", "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass;"),
+        ("INDEX", "SELECT i.relname FROM pg_index x "
+         "JOIN pg_class i ON i.oid = x.indexrelid "
+         "WHERE x.indrelid = %s::regclass AND NOT EXISTS "
+         "(SELECT 1 FROM pg_constraint c "
+         "WHERE c.conrelid = x.indrelid AND c.conindid = x.indexrelid);"),
+    ]
+    rename_sql = {
+        "SEQUENCE": "ALTER SEQUENCE {name} RENAME TO {new_name};",
+        "CONSTRAINT": "ALTER TABLE {table} RENAME CONSTRAINT {name} TO {new_name};",
+        "INDEX": "ALTER INDEX {name} RENAME TO {new_name};",
+    }
+
+    def get_objects(table_name):
+        return [(kind, row[0])
+                for kind, sql in queries
+                for row in fetch_with_column_names(schema_editor, sql, [qn(table_name)])[0]]
+
+    def make_renamer(replacements):
+        # Replaces table and column names within names, longest first,
+        # e.g. 'auth_user_groups_user_id_6a12ed8b_fk_auth_user_id' becomes
+        # 'accounts_myuser_groups_myuser_id_6a12ed8b_fk_accounts_myuser_id'
+        replacements = dict(replacements)
+        regex = re.compile("|".join(re.escape(old) for old in
+                                    sorted(replacements, key=len, reverse=True)))
+        return lambda name: truncate_name(
+            regex.sub(lambda m: replacements[m.group(0)], name), max_length)
+
+    def rename(table_name, new_table_name, objects, make_new_name):
+        for kind, name in objects:
+            new_name = make_new_name(name)
+            if new_name != name:
+                schema_editor.execute(rename_sql[kind].format(
+                    table=qn(table_name), name=qn(name), new_name=qn(new_name)))
+        schema_editor.execute("ALTER TABLE {0} RENAME TO {1};".format(
+            qn(table_name), qn(new_table_name)))
+
+    from_column = fk_column_name(model_pairs[0][1])
+    to_column = fk_column_name(model_pairs[0][3])
+    from_renamer = make_renamer([(from_table_name, to_table_name)
+                                 for from_table_name, to_table_name in table_pairs] +
+                                [(from_column, to_column)])
+    to_renamer = make_renamer([(to_table_name, from_table_name)
+                               for from_table_name, to_table_name in table_pairs] +
+                              [(to_column, from_column)])
+    from_objects = [get_objects(from_table_name) for from_table_name, to_table_name in table_pairs]
+    to_objects = [get_objects(to_table_name) for from_table_name, to_table_name in table_pairs]
+
+    # Names of tables, sequences and indexes share a namespace, so the 'from'
+    # things are moved out of the way first.
+    temp_name = lambda i, j: truncate_name("{0}_swap_{1}_{2}".format(table_pairs[0][0], i, j),
+                                           max_length)
+    for i, (from_table_name, to_table_name) in enumerate(table_pairs):
+        names = dict((name, temp_name(i, j)) for j, (kind, name) in enumerate(from_objects[i]))
+        rename(from_table_name, temp_name(i, "table"), from_objects[i], names.get)
+    for i, (from_table_name, to_table_name) in enumerate(table_pairs):
+        rename(to_table_name, from_table_name, to_objects[i], to_renamer)
+    for i, (from_table_name, to_table_name) in enumerate(table_pairs):
+        names = dict((temp_name(i, j), from_renamer(name))
+                     for j, (kind, name) in enumerate(from_objects[i]))
+        rename(temp_name(i, "table"), to_table_name,
+               [(kind, temp_name(i, j)) for j, (kind, name) in enumerate(from_objects[i])],
+               names.get)
+
+    # The auto-created M2M tables point to the model with a column named
+    # after it.
+    for from_table_name, to_table_name in table_pairs[1:]:
+        for table_name, old_column, new_column in [(to_table_name, from_column, to_column),
+                                                   (from_table_name, to_column, from_column)]:
+            schema_editor.execute("ALTER TABLE {0} RENAME COLUMN {1} TO {2};".format(
+                qn(table_name), qn(old_column), qn(new_column)))
+
+
+def get_table_size(schema_editor, table_name):
+    # Returns the number of bytes used by the table and its indexes, or None
+    # if the database can't tell us.
+    from django.db import DatabaseError
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        sql = "SELECT pg_total_relation_size(%s::regclass);"
+        params = [connection.ops.quote_name(table_name)]
+    elif connection.vendor == 'mysql':
+        sql = ("SELECT data_length + index_length FROM information_schema.tables "
+               "WHERE table_schema = DATABASE() AND table_name = %s;")
+        params = [table_name]
+    elif connection.vendor == 'sqlite':
+        # Needs SQLite to be compiled with SQLITE_ENABLE_DBSTAT_VTAB
+        sql = "SELECT SUM(pgsize) FROM dbstat WHERE name = %s;"
+        params = [table_name]
+    else:
+        return None
+    try:
+        rows = fetch_with_column_names(schema_editor, sql, params)[0]
+    except DatabaseError:
+        return None
+    return rows[0][0] if rows else None
+
+
+def get_index_count(schema_editor, table_name):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table_name)
+    return len([info for info in constraints.values() if info['index']])
+
+
+def measure_throughput(schema_editor, table_name, sample_size):
+    # Returns the rows per second for copying, scanning and deleting rows, by
+    # timing them on up to sample_size rows of table_name copied into a
+    # temporary table, which is dropped afterwards, or None if the table is
+    # empty. Where DDL is transactional, the caller should roll back the
+    # transaction afterwards, in case measuring fails part way.
+    import time
+    from django.db.backends.utils import truncate_name
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    sample_table_name = truncate_name("{0}_sample".format(table_name),
+                                      connection.ops.max_name_length())
+    if connection.vendor == 'mysql':
+        schema_editor.execute("CREATE TEMPORARY TABLE {0} LIKE {1};".format(
+            qn(sample_table_name), qn(table_name)))
+    else:
+        schema_editor.execute(
+            "CREATE TEMPORARY TABLE {0} AS SELECT * FROM {1} WHERE 1 = 0;".format(
+                qn(sample_table_name), qn(table_name)))
+
+    def timed(sql):
+        start = time.time()
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            rows = cursor.rowcount
+        return rows, max(time.time() - start, 1e-6)
+
+    copied, copy_time = timed("INSERT INTO {0} SELECT * FROM {1} ORDER BY id LIMIT {2};".format(
+        qn(sample_table_name), qn(table_name), int(sample_size)))
+    scan_time = timed(
+        "SELECT COUNT(*) FROM (SELECT * FROM {0} ORDER BY id LIMIT {1}) sample;".format(
+            qn(table_name), int(sample_size)))[1]
+    deleted, delete_time = timed("DELETE FROM {0};".format(qn(sample_table_name)))
+    schema_editor.execute("DROP TABLE {0};".format(qn(sample_table_name)))
+    if copied <= 0:
+        return None
+    return {'copy': copied / copy_time,
+            'scan': copied / scan_time,
+            'delete': deleted / delete_time}
+
+
+def compare_tables(schema_editor, from_table_name, to_table_name, from_model, to_model,
+                   chunk_size=100000, row_chunk_size=100, max_differences=100):
+    # Checks that to_table_name holds the same rows as from_table_name, with
+    # the user FK column renamed. Hashes of chunks of chunk_size ids are
+    # compared first, and only the chunks that differ are split into smaller
+    # chunks, until they are no bigger than row_chunk_size and their rows can
+    # be compared. Returns the number of rows in from_table_name, and a dict
+    # of the ids that are 'missing' from the new table, 'extra' in it, or
+    # 'changed', stopping after max_differences ids.
+    ops = schema_editor.connection.ops
+    old_cols = get_column_names(schema_editor, from_table_name)
+    new_cols = map_column_names(from_model, to_model, old_cols)
+    id_index = old_cols.index("id")
+    differences = {'missing': [], 'extra': [], 'changed': []}
+
+    def fetch_rows(table_name, cols, lower, upper):
+        rows = fetch_with_column_names(
+            schema_editor,
+            "SELECT {0} FROM {1} WHERE id >= %s AND id < %s;".format(
+                ", ".join(ops.quote_name(col_name) for col_name in cols),
+                ops.quote_name(table_name)),
+            [lower, upper])[0]
+        return dict((row[id_index], row) for row in rows)
+
+    def compare(size, lower, upper):
+        old_hashes = get_chunk_hashes(schema_editor, from_table_name, old_cols, size,
+                                      lower, upper)
+        new_hashes = get_chunk_hashes(schema_editor, to_table_name, new_cols, size,
+                                      lower, upper)
+        for chunk in sorted(set(old_hashes) | set(new_hashes)):
+            if old_hashes.get(chunk) == new_hashes.get(chunk):
+                continue
+            if sum(len(ids) for ids in differences.values()) >= max_differences:
+                break
+            chunk_lower, chunk_upper = chunk * size, (chunk + 1) * size
+            if size > row_chunk_size:
+                compare(max(size // 100, row_chunk_size), chunk_lower, chunk_upper)
+                continue
+            old_rows = fetch_rows(from_table_name, old_cols, chunk_lower, chunk_upper)
+            new_rows = fetch_rows(to_table_name, new_cols, chunk_lower, chunk_upper)
+            for row_id in sorted(set(old_rows) | set(new_rows)):
+                if row_id not in new_rows:
+                    differences['missing'].append(row_id)
+                elif row_id not in old_rows:
+                    differences['extra'].append(row_id)
+                elif old_rows[row_id] != new_rows[row_id]:
+                    differences['changed'].append(row_id)
+        return sum(count for count, row_hash in old_hashes.values())
+
+    rows = compare(chunk_size, None, None)
+    for ids in differences.values():
+        del ids[max_differences:]
+    return rows, differences
+
+
+def get_chunk_hashes(schema_editor, table_name, cols, chunk_size, lower=None, upper=None):
+    # Returns a dict mapping each chunk of chunk_size ids in table_name (id //
+    # chunk_size) to the number of rows in it and the sum of a 40 bit hash of
+    # each row's values for cols, optionally only for ids from lower up to
+    # upper. The sum doesn't depend on the order of the rows, and can't
+    # overflow as long as chunk_size is less than 2 ** 23.
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    col_list = ", ".join(qn(col_name) for col_name in cols)
+    if connection.vendor == 'postgresql':
+        chunk_sql = "id / {0}".format(int(chunk_size))
+        hash_sql = "('x' || substr(md5(ROW({0})::text), 1, 10))::bit(40)::bigint".format(
+            col_list)
+    elif connection.vendor == 'mysql':
+        chunk_sql = "id DIV {0}".format(int(chunk_size))
+        # CONV returns a string, which SUM would add up as a DOUBLE
+        hash_sql = ("CAST(CONV(SUBSTRING(MD5(CONCAT_WS(',', {0})), 1, 10), 16, 10) "
+                    "AS UNSIGNED)".format(
+                        ", ".join("QUOTE({0})".format(qn(col_name)) for col_name in cols)))
+    elif connection.vendor == 'sqlite':
+        import hashlib
+        connection.ensure_connection()
+        connection.connection.create_function(
+            "custom_user_migration_row_hash", -1,
+            lambda *values: int(hashlib.md5(repr(values).encode('utf-8')).hexdigest()[:10], 16))
+        chunk_sql = "id / {0}".format(int(chunk_size))
+        hash_sql = "custom_user_migration_row_hash({0})".format(col_list)
+    else:
+        raise NotImplementedError("Hashing rows is not supported on {0}".format(
+            connection.vendor))
+    where, params = [], []
+    if lower is not None:
+        where.append("id >= %s")
+        params.append(lower)
+    if upper is not None:
+        where.append("id < %s")
+        params.append(upper)
+    rows = fetch_with_column_names(
+        schema_editor,
+        "SELECT {0}, COUNT(*), SUM({1}) FROM {2}{3} GROUP BY {0};".format(
+            chunk_sql, hash_sql, qn(table_name),
+            " WHERE " + " AND ".join(where) if where else ""),
+        params)[0]
+    return dict((chunk, (count, row_hash)) for chunk, count, row_hash in rows)
+
+
+def check_row_counts(schema_editor, from_table_name, to_table_name):
     ops = schema_editor.connection.ops
-    schema_editor.execute("DELETE FROM {0};".format(ops.quote_name(from_table_name)))
+    counts = [fetch_with_column_names(
+        schema_editor, "SELECT COUNT(*) FROM {0};".format(ops.quote_name(table_name)), []
+    )[0][0][0] for table_name in [from_table_name, to_table_name]]
+    if counts[0] != counts[1]:
+        raise RuntimeError("Copied {0} rows from {1} to {2}, but {3} rows were expected".format(
+            counts[1], from_table_name, to_table_name, counts[0]))
+
+
+def copy_table_postgresql(schema_editor, from_table_name, to_table_name, old_cols, new_cols,
+                          batch_size, where=None, progress=None):
+    # Each batch is read with COPY ... TO STDOUT into a buffer, and written
+    # with COPY ... FROM STDIN, so memory use is bounded by batch_size.
+    import io
+    ops = schema_editor.connection.ops
+    id_index = old_cols.index("id")
+    copy_from_sql = "COPY {0} ({1}) FROM STDIN".format(
+        ops.quote_name(to_table_name),
+        ", ".join(ops.quote_name(col_name) for col_name in new_cols))
+    last_id = None
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            conditions = ([] if where is None else [where]) + (
+                [] if last_id is None else ["id > {0}".format(int(last_id))])
+            copy_to_sql = "COPY (SELECT {0} FROM {1} {2}ORDER BY id LIMIT {3}) TO STDOUT".format(
+                ", ".join(ops.quote_name(col_name) for col_name in old_cols),
+                ops.quote_name(from_table_name),
+                "WHERE {0} ".format(" AND ".join(conditions)) if conditions else "",
+                int(batch_size))
+            buf = io.BytesIO()
+            cursor.copy_expert(copy_to_sql, buf)
+            data = buf.getvalue()
+            if not data:
+                break
+            # Tabs and newlines within values are escaped in COPY text format,
+            # so we can find the last id by splitting.
+            last_line = data.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+            last_id = int(last_line.split(b"\t")[id_index])
+            buf.seek(0)
+            cursor.copy_expert(copy_from_sql, buf)
+            if progress is not None:
+                progress(data.count(b"\n"))
+
+
+def get_max_query_params(schema_editor):
+    connection = schema_editor.connection
+    max_query_params = getattr(connection.features, 'max_query_params', None)
+    if max_query_params is not None:
+        return max_query_params
+    if connection.vendor == 'sqlite':
+        # SQLITE_MAX_VARIABLE_NUMBER defaults to 999 before SQLite 3.32.0,
+        # and 32766 from then on.
+        import sqlite3
+        return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    if connection.vendor == 'oracle':
+        return 1000
+    # Limit imposed by the PostgreSQL and MySQL protocols
+    return 65535
+
+
+def make_insert_sql(schema_editor, table_name, cols, num_rows):
+    ops = schema_editor.connection.ops
+    row_sql = "({0})".format(", ".join(["%s"] * len(cols)))
+    return "INSERT INTO {0} ({1}) VALUES {2};".format(
+        ops.quote_name(table_name),
+        ", ".join(ops.quote_name(col_name) for col_name in cols),
+        ", ".join([row_sql] * num_rows))
+
+
+def empty_table(apps, schema_editor, from_app, from_model, empty_mode="delete",
+                batch_size=1000, vacuum=False, database=None):
+    # empty_mode can be:
+    # - "delete", a single DELETE statement.
+    # - "truncate", TRUNCATE on PostgreSQL and MySQL, which doesn't leave dead
+    #   rows behind. Tables with FKs pointing to this one must be emptied in
+    #   the same statement, so it is only done if they are already empty.
+    #   Otherwise, and on other databases, this falls back to DELETE.
+    # - "chunked", DELETE in batches of batch_size rows, committing after
+    #   each batch, so that locks and undo logs stay small.
+    # With vacuum, space is reclaimed afterwards on PostgreSQL and SQLite,
+    # which can only be done outside a transaction.
+    # database is the alias of the database holding the table, if it isn't
+    # the one being migrated.
+    schema_editor = get_database_editor(schema_editor, database)
+    from_table_name = make_table_name(apps, from_app, from_model)
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+    if empty_mode == "truncate":
+        if connection.vendor in ['postgresql', 'mysql']:
+            referencing_table_names = get_referencing_table_names(schema_editor,
+                                                                  from_table_name)
+            if any(fetch_with_column_names(
+                    schema_editor, "SELECT 1 FROM {0} LIMIT 1;".format(qn(table_name)), [])[0]
+                    for table_name in referencing_table_names):
+                empty_mode = "delete"
+        else:
+            empty_mode = "delete"
+
+    def empty():
+        if empty_mode == "truncate" and connection.vendor == 'postgresql':
+            schema_editor.execute("TRUNCATE {0};".format(", ".join(
+                qn(table_name) for table_name in [from_table_name] + referencing_table_names)))
+        elif empty_mode == "truncate":
+            # MySQL refuses to truncate tables that FKs point to, even if the FKs
+            # are on empty tables.
+            schema_editor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+            try:
+                schema_editor.execute("TRUNCATE TABLE {0};".format(qn(from_table_name)))
+            finally:
+                schema_editor.execute("SET FOREIGN_KEY_CHECKS = 1;")
+        elif empty_mode == "chunked":
+            def delete_batches(editor):
+                while True:
+                    upper = get_batch_upper_id(editor, from_table_name, None, batch_size)
+                    if upper is None:
+                        break
+                    editor.execute("DELETE FROM {0} WHERE id <= %s;".format(qn(from_table_name)),
+                                   [upper])
+            run_with_commits(schema_editor, delete_batches)
+        else:
+            schema_editor.execute("DELETE FROM {0};".format(qn(from_table_name)))
+
+        if vacuum and not connection.in_atomic_block:
+            if connection.vendor == 'postgresql':
+                schema_editor.execute("VACUUM {0};".format(qn(from_table_name)))
+            elif connection.vendor == 'sqlite':
+                schema_editor.execute("VACUUM;")
+
+        # Forget any checkpoints of resumable copies into the table
+        with schema_editor.connection.cursor() as cursor:
+            table_names = schema_editor.connection.introspection.table_names(cursor)
+        if "custom_user_migration_progress" in table_names:
+            schema_editor.execute("DELETE FROM custom_user_migration_progress "
+                                  "WHERE target_table = %s;", [from_table_name])
+
+    record_phase(schema_editor, "empty", from_table_name, empty)
+
+
+def get_referencing_table_names(schema_editor, table_name):
+    # Returns the names of other tables with FKs that point to table_name
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        return [other_table_name
+                for other_table_name in connection.introspection.table_names(cursor)
+                if other_table_name != table_name and any(
+                    info['foreign_key'] and info['foreign_key'][0] == table_name
+                    for info in connection.introspection.get_constraints(
+                        cursor, other_table_name).values())]
 
 
 def get_max_id(schema_editor, table_name):
@@ -111,18 +1557,127 @@ def reset_sequence(apps, schema_editor, app, model):
                               [sequence_name, get_max_id(schema_editor, table_name) + 1])
 
 
-def change_foreign_keys(apps, schema_editor, from_app, from_model_name, to_app, to_model_name):
-    from django.db import models
+def change_foreign_keys(apps, schema_editor, from_app, from_model_name, to_app, to_model_name,
+                        low_lock=False, workers=1, run=None):
+    # run is used as by populate_table, when the tables are altered one at a
+    # time.
+    import logging
+    from collections import OrderedDict
+    logger = logging.getLogger('django_custom_user_migration')
     FromModel = apps.get_model(from_app, from_model_name)
     ToModel = apps.get_model(to_app, to_model_name)
 
+    changes, skipped = find_foreign_keys(FromModel, ToModel, from_model_name, to_model_name)
+    for rel in skipped:
+        logger.info("Skipping %r", rel)
+
+    # FKs are grouped by table, so that each table is only altered once.
+    tables = OrderedDict()
+
+    for fk_field, old_field, new_field in changes:
+        show = lambda m: "{0}.{1}".format(m._meta.app_label, m.__name__)
+        logger.info("Fixing FK in %s, col %s -> %s, from %s -> %s",
+                    show(fk_field.model),
+                    old_field.column, new_field.column,
+                    show(old_field.rel.to), show(new_field.rel.to))
+        model, field_pairs = tables.setdefault(fk_field.model._meta.db_table,
+                                               (fk_field.model, []))
+        field_pairs.append((old_field, new_field))
+
+    # The number of times tables are altered or rebuilt
+    alterations = []
+
+    def alter_tables(editor):
+        for table_name, (model, field_pairs) in tables.items():
+            alterations.append(record_phase(editor, "alter", table_name,
+                                            lambda: alter_foreign_keys(
+                                                editor, model, field_pairs, low_lock=low_lock)))
+
+    def alter():
+        record = get_phase_records(schema_editor.connection)[-1]
+        if workers > 1 and schema_editor.connection.vendor != 'sqlite':
+            run_with_commits(schema_editor, lambda editor: alterations.append(
+                alter_foreign_keys_parallel(editor, tables, ToModel._meta.db_table, workers,
+                                            low_lock=low_lock)))
+        elif run is not None:
+            run(schema_editor, alter_tables)
+        else:
+            alter_tables(schema_editor)
+        record['alterations'] = sum(alterations)
+    field_count = sum(len(field_pairs) for model, field_pairs in tables.values())
+    record_phase(schema_editor, "schema", ToModel._meta.db_table, alter,
+                 foreign_keys=field_count, tables=len(tables))
+    logger.info("Altered %d foreign keys in %d tables, with %d table alterations",
+                field_count, len(tables), sum(alterations))
+
+
+def alter_foreign_keys_parallel(schema_editor, tables, to_table_name, workers, low_lock=False):
+    # Calls alter_foreign_keys for the tables in the dict tables (as built by
+    # change_foreign_keys), using up to workers threads, each with their own
+    # connection. Each table is altered in its own transaction, or a
+    # statement at a time with low_lock. Tables that have been done are
+    # recorded in the progress table, so that if any fail, running the
+    # migration again only alters the rest. Returns the number of table
+    # alterations, as alter_foreign_keys does.
+    #
+    # On PostgreSQL, adding a foreign key locks the table it points to
+    # against other foreign keys being added until the transaction ends, so
+    # the workers would wait for each other. low_lock is always used there,
+    # which only holds that lock briefly while each constraint is added.
+    import logging
+    low_lock = low_lock or schema_editor.connection.vendor == 'postgresql'
+    ensure_progress_table(schema_editor)
+    tasks = []
+    for table_name, (model, field_pairs) in tables.items():
+        if get_checkpoint(schema_editor, table_name, to_table_name) is None:
+            tasks.append((table_name, model, field_pairs))
+        else:
+            logging.getLogger('django_custom_user_migration').info(
+                "Skipping %s, which has already been altered", table_name)
+
+    alterations = []
+
+    def alter(connection, task):
+        table_name, model, field_pairs = task
+        # The progress table's last_id isn't needed here
+        editor = connection.schema_editor()
+
+        def alter_table():
+            if low_lock:
+                alterations.append(alter_foreign_keys(editor, model, field_pairs, low_lock=True))
+                set_checkpoint(editor, table_name, to_table_name, 0)
+            else:
+                with editor:
+                    alterations.append(alter_foreign_keys(editor, model, field_pairs))
+                    set_checkpoint(editor, table_name, to_table_name, 0)
+        record_phase(editor, "alter", table_name, alter_table)
+
+    errors = run_in_threads(schema_editor, tasks, alter, workers, stop_on_error=False)
+    if errors:
+        raise RuntimeError(
+            "Failed to alter foreign keys in {0} tables, run the migration again to retry:\n"
+            "{1}".format(len(errors), "\n".join("  {0}: {1}".format(task[0], e)
+                                                for task, e in errors)))
+    for table_name in tables:
+        schema_editor.execute("DELETE FROM custom_user_migration_progress "
+                              "WHERE source_table = %s AND target_table = %s;",
+                              [table_name, to_table_name])
+    return sum(alterations)
+
+
+def find_foreign_keys(FromModel, ToModel, from_model_name, to_model_name):
+    # Returns a list of (fk_field, old_field, new_field) for FKs that need
+    # changing to point to ToModel instead of FromModel, and a list of the
+    # relations that are skipped.
+    from django.db import models
+
     # We don't make assumptions about which model is being pointed to by
     # AUTH_USER_MODEL. So include fields from both FromModel and ToModel.
     # Only one of them will actually have FK fields pointing to them.
-
-    print()
     fields = (FromModel._meta.get_fields(include_hidden=True) +
               ToModel._meta.get_fields(include_hidden=True))
+    changes = []
+    skipped = []
 
     for rel in fields:
         if not hasattr(rel, 'field') or not isinstance(rel.field, models.ForeignKey):
@@ -147,7 +1702,7 @@ def change_foreign_keys(apps, schema_editor, from_app, from_model_name, to_app,
             # we've already dealt with this, by virtue of the data migration
             # that populates the auto-created M2M field.
             if fk_field.model._meta.auto_created in [ToModel, FromModel]:
-                print("Skipping {0}".format(repr(rel)))
+                skipped.append(rel)
                 continue
 
             # In this case (FK fields that are part of an autogenerated M2M),
@@ -170,17 +1725,216 @@ def change_foreign_keys(apps, schema_editor, from_app, from_model_name, to_app,
             new_field.name = fk_field.name
             new_field.column = fk_field.column
 
-        show = lambda m: "{0}.{1}".format(m._meta.app_label, m.__name__)
-        print("Fixing FK in {0}, col {1} -> {2}, from {3} -> {4}".format(
-            show(fk_field.model),
-            old_field.column, new_field.column,
-            show(old_field.rel.to), show(new_field.rel.to),
-        ))
-        schema_editor.alter_field(fk_field.model, old_field, new_field, strict=True)
+        changes.append((fk_field, old_field, new_field))
+    return changes, skipped
+
+
+def alter_foreign_keys(schema_editor, model, field_pairs, low_lock=False):
+    # Does the same as calling alter_field for each (old_field, new_field)
+    # pair, but with a single ALTER TABLE (one for the drops and one for the
+    # adds on MySQL), or a single rebuild on SQLite before Django 1.11.
+    # Returns the number of times the table was altered or rebuilt, not
+    # counting renames.
+    #
+    # With low_lock on PostgreSQL, existing rows aren't checked while strong
+    # locks are held. The new constraints are added as NOT VALID, so only new
+    # rows are checked, the old constraints are dropped, and then the new
+    # constraints are validated, which doesn't block reads or writes. Outside
+    # a transaction (atomic = False on Django 1.10 and later) each statement
+    # is committed separately, and indexes are built concurrently.
+    import inspect
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+        if 'alter_fields' in getargspec(schema_editor._remake_table).args:
+            schema_editor._remake_table(model, alter_fields=field_pairs)
+            return 1
+        # Django 1.11 and later rebuild the table for one field at a time
+        for old_field, new_field in field_pairs:
+            schema_editor._remake_table(model, alter_field=(old_field, new_field))
+        return len(field_pairs)
+    if connection.vendor not in ['postgresql', 'mysql']:
+        for old_field, new_field in field_pairs:
+            schema_editor.alter_field(model, old_field, new_field, strict=True)
+        return len(field_pairs)
+
+    qn = schema_editor.quote_name
+    table_name = model._meta.db_table
+    low_lock = low_lock and connection.vendor == 'postgresql'
+    alter_table = "ALTER TABLE {0} ".format(qn(table_name))
+    drops = []
+    adds = []
+    fk_names = []
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table_name)
+    for old_field, new_field in field_pairs:
+        to_table_name = new_field.target_field.model._meta.db_table
+        to_column = new_field.target_field.column
+        fk_name = schema_editor._create_index_name(
+            model, [new_field.column], suffix="_fk_{0}_{1}".format(to_table_name, to_column))
+        old_fk_names = [name for name, info in sorted(constraints.items())
+                        if info['foreign_key'] and info['columns'] == [old_field.column]]
+        if old_field.db_constraint and len(old_fk_names) != 1:
+            # As alter_field(..., strict=True) does
+            raise ValueError("Found wrong number ({0}) of foreign key constraints for {1}.{2}"
+                             .format(len(old_fk_names), table_name, old_field.column))
+        if old_field.column != new_field.column:
+            new_type = new_field.db_parameters(connection=connection)['type']
+            schema_editor.execute(schema_editor._rename_field_sql(table_name, old_field,
+                                                                  new_field, new_type))
+
+        if (connection.vendor == 'postgresql' and old_field.db_constraint and
+                new_field.db_constraint and
+                constraints[old_fk_names[0]]['foreign_key'] == (to_table_name, to_column)):
+            # The rows have been moved by swap_tables, so the constraint
+            # already refers to the new table, and only its name is wrong.
+            if old_fk_names[0] != fk_name:
+                schema_editor.execute("{0}RENAME CONSTRAINT {1} TO {2}".format(
+                    alter_table, qn(old_fk_names[0]), qn(fk_name)))
+            continue
 
+        if old_field.db_constraint:
+            drops.append(schema_editor.sql_delete_fk % {
+                "table": qn(table_name),
+                "name": qn(old_fk_names[0]),
+            })
+        if not new_field.db_constraint:
+            continue
+
+        if low_lock and new_field.db_index and not schema_editor._constraint_names(
+                model, [new_field.column], index=True):
+            sql = schema_editor.sql_create_index
+            if not connection.in_atomic_block:
+                sql = sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+            schema_editor.execute(schema_editor._create_index_sql(model, [new_field], sql=sql))
+
+        fk_names.append(fk_name)
+        adds.append(schema_editor.sql_create_fk % {
+            "table": qn(table_name),
+            "name": qn(fk_name),
+            "column": qn(new_field.column),
+            "to_table": qn(to_table_name),
+            "to_column": qn(to_column),
+        } + (" NOT VALID" if low_lock else ""))
+
+    if not adds and not drops:
+        return 0
+    if low_lock:
+        # Old constraints are dropped after the new ones are added, so
+        # that there is no gap where the column isn't checked.
+        statements = [adds + drops]
+    elif connection.vendor == 'mysql':
+        # MySQL rejects dropping and adding foreign keys in the same ALTER
+        # TABLE when the table is copied.
+        statements = [drops, adds]
+    else:
+        statements = [drops + adds]
+    statements = [clauses for clauses in statements if clauses]
+    for clauses in statements:
+        schema_editor.execute(alter_table + ", ".join(clause[len(alter_table):]
+                                                      for clause in clauses))
+    if low_lock:
+        for fk_name in fk_names:
+            schema_editor.execute("{0}VALIDATE CONSTRAINT {1}".format(alter_table, qn(fk_name)))
+    return len(statements)
 
-def fix_contenttype(apps, schema_editor, from_app, from_model, to_app, to_model):
+
+def fix_contenttype(apps, schema_editor, from_app, from_model, to_app, to_model,
+                    batch_size=1000):
     from_model, to_model = from_model.lower(), to_model.lower()
-    schema_editor.execute(
-        "UPDATE django_content_type SET app_label=%s, model=%s WHERE app_label=%s AND model=%s;",
-        [to_app, to_model, from_app, from_model])
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    content_types = ContentType.objects.using(schema_editor.connection.alias)
+
+    # If the migrations have been run one at a time (e.g. to verify the
+    # populate migration), post_migrate will already have created a content
+    # type for the new model, and permissions, log entries and generic
+    # relations may point to it. They are moved to the content type of the
+    # old model, and the new one is deleted to make way for it.
+    def fix():
+        old_content_type = content_types.filter(app_label=from_app, model=from_model).first()
+        new_content_type = content_types.filter(app_label=to_app, model=to_model).first()
+        if old_content_type is not None and new_content_type is not None:
+            remap_contenttype_references(apps, schema_editor, new_content_type.id,
+                                         old_content_type.id, batch_size)
+            # Deletes anything that couldn't be moved, e.g. duplicate permissions
+            new_content_type.delete()
+        schema_editor.execute(
+            "UPDATE django_content_type SET app_label=%s, model=%s "
+            "WHERE app_label=%s AND model=%s;",
+            [to_app, to_model, from_app, from_model])
+    record_phase(schema_editor, "contenttypes", ContentType._meta.db_table, fix)
+
+    # This process's cache of content types is now out of date. Other
+    # processes using the database need to be restarted.
+    from django.apps import apps as global_apps
+    if global_apps.is_installed('django.contrib.contenttypes'):
+        from django.contrib.contenttypes.models import ContentType as GlobalContentType
+        GlobalContentType.objects.clear_cache()
+
+
+def remap_contenttype_references(apps, schema_editor, old_id, new_id, batch_size):
+    # Changes every foreign key to ContentType (such as those of permissions,
+    # admin log entries and generic relations) that points to old_id to point
+    # to new_id instead, using UPDATEs of up to batch_size rows. Rows that
+    # would then clash with a unique constraint are left alone.
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+
+    def remap_batches(table_name, column, pk_column, where, params, total):
+        progress = make_progress(schema_editor, table_name, table_name, total=total)
+        while True:
+            upper = fetch_with_column_names(
+                schema_editor,
+                "SELECT MAX({0}) FROM (SELECT {0} FROM {1} WHERE {2} "
+                "ORDER BY {0} LIMIT {3}) batch;".format(
+                    pk_column, qn(table_name), where, int(batch_size)),
+                params)[0][0][0]
+            if upper is None:
+                break
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE {0} SET {1} = %s WHERE {2} AND {3} <= %s;".format(
+                    qn(table_name), column, where, pk_column),
+                    [new_id] + params + [upper])
+                progress(cursor.rowcount)
+
+    with connection.cursor() as cursor:
+        table_names = connection.introspection.table_names(cursor)
+    for model in apps.get_models():
+        opts = model._meta
+        if opts.proxy or opts.swapped or not opts.managed or opts.db_table not in table_names:
+            continue
+        for field in opts.local_fields:
+            if not (field.is_relation and field.many_to_one and field.rel.to is ContentType):
+                continue
+            table_name = opts.db_table
+            column = qn(field.column)
+            pk_column = qn(opts.pk.column)
+            # Rows whose unique_together values are already taken with new_id
+            excluded = set()
+            for field_names in opts.unique_together:
+                if field.name not in field_names:
+                    continue
+                excluded.update(row[0] for row in fetch_with_column_names(
+                    schema_editor,
+                    "SELECT a.{0} FROM {1} a JOIN {1} b ON {2} "
+                    "WHERE a.{3} = %s AND b.{3} = %s;".format(
+                        pk_column, qn(table_name),
+                        " AND ".join("a.{0} = b.{0}".format(qn(opts.get_field(name).column))
+                                     for name in field_names if name != field.name),
+                        column),
+                    [old_id, new_id])[0])
+            where = "{0} = %s".format(column)
+            params = [old_id]
+            if excluded:
+                where += " AND {0} NOT IN ({1})".format(
+                    pk_column, ", ".join(["%s"] * len(excluded)))
+                params += sorted(excluded)
+            total = fetch_with_column_names(
+                schema_editor,
+                "SELECT COUNT(*) FROM {0} WHERE {1};".format(qn(table_name), where),
+                params)[0][0][0]
+            if not total:
+                continue
+            record_phase(schema_editor, "remap", table_name, lambda: remap_batches(
+                table_name, column, pk_column, where, params, total))
@@ -2,14 +2,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import ast
+import glob
+import json
 import os.path
 import shutil
 import subprocess
 import unittest
 
+import django
+
 
 class TestProcessBase(object):
 
+    # Extra options passed to the commands that create populate/empty migrations
+    populate_options = ""
+
+    # Extra options passed to the command that creates the schema migration
+    schema_options = ""
+
+    # Create all the migrations with create_custom_user_migrations
+    combined = False
+
     def setUp(self):
         self.copy_test_project()
         self.set_db()
@@ -39,14 +53,37 @@ class TestProcessBase(object):
         self.add_to_installed_apps("accounts")
         # Step 4:
         self.shell("./manage.py makemigrations accounts")
-        # Step 5:
-        self.shell("./manage.py create_custom_user_populate_migration auth.User accounts.MyUser")
-        # Step 6:
-        self.shell("./manage.py create_custom_user_schema_migration auth.User accounts.MyUser")
-        # Step 7:
-        self.shell("./manage.py create_custom_user_contenttypes_migration "
-                   "auth.User accounts.MyUser")
+        # Optional - check the plan:
+        self.shell("./manage.py plan_custom_user_migration auth.User accounts.MyUser")
+        self.set_progress_callback("myapp.progress.record_progress")
+        self.set_report("report.log")
+        if self.combined:
+            # Steps 5, 6, 7 and 12 in one go:
+            self.shell("./manage.py create_custom_user_migrations auth.User accounts.MyUser " +
+                       self.populate_options + " " + self.schema_options)
+        else:
+            # Step 5:
+            self.shell("./manage.py create_custom_user_populate_migration "
+                       "auth.User accounts.MyUser " + self.populate_options)
+            # Optional - run the populate migration on its own, and check it:
+            self.shell("./manage.py migrate --noinput")
+            self.check_populated()
+            self.check_verify_finds_differences()
+            self.check_populate_reversed()
+            # This creates a content type for the new model, which the
+            # contenttypes migration needs to merge with the old one:
+            self.shell("./manage.py myproject_new_user_permission")
+            self.shell("./manage.py myproject_test_permission_cache")
+            # Step 6:
+            self.shell("./manage.py create_custom_user_schema_migration "
+                       "auth.User accounts.MyUser " + self.schema_options)
+            # Step 7:
+            self.shell("./manage.py create_custom_user_contenttypes_migration "
+                       "auth.User accounts.MyUser")
         # Step 8:
+        if self.combined:
+            # Needed on Django 1.10 and later, and already done otherwise
+            self.shell("./manage.py migrate --noinput accounts 0001")
         self.replace_user_import("from django_custom_user_migration.models import AbstractUser",
                                  "from django.contrib.auth.models import AbstractUser")
         # Step 9:
@@ -55,12 +92,19 @@ class TestProcessBase(object):
         self.shell("./manage.py makemigrations accounts")
         # Step 11 - skip
         # Step 12:
-        self.shell("./manage.py create_custom_user_empty_migration auth.User accounts.MyUser")
+        if not self.combined:
+            self.shell("./manage.py create_custom_user_empty_migration "
+                       "auth.User accounts.MyUser " + self.populate_options)
         # Step 13:
         self.shell("./manage.py migrate --noinput")
+        self.check_progress_log()
+        self.check_report()
+        self.check_copied_functions()
         # Step 14:
         # Custom management command to test migrated data
         self.shell("./manage.py myproject_test_migrated_data")
+        if not self.combined:
+            self.shell("./manage.py myproject_new_user_permission --check")
 
         # Test reverse migrations
         self.set_auth_user_model("auth.User")
@@ -81,6 +125,11 @@ class TestProcessBase(object):
         """Run a shell command, from inside test_project dir"""
         subprocess.check_call("cd test_project; " + command, shell=True)
 
+    def shell_output(self, command):
+        """Run a shell command, from inside test_project dir, returning its output"""
+        return subprocess.check_output("cd test_project; " + command,
+                                       shell=True).decode('utf-8')
+
     def add_to_installed_apps(self, item):
         self.change_file_chunk("test_project/myapp/settings.py",
                                "    # INSTALLED_APPS_start",
@@ -116,6 +165,89 @@ class MyUser(AbstractUser):
         with change_file("test_project/accounts/models.py") as f:
             f.write(f.contents.replace(from_import, to_import))
 
+    def set_progress_callback(self, callback_path):
+        with change_file("test_project/myapp/settings.py") as f:
+            f.write(f.contents + "\nCUSTOM_USER_MIGRATION_PROGRESS_CALLBACK = {0}\n".format(
+                repr(callback_path)))
+
+    def check_populated(self):
+        self.shell("./manage.py verify_custom_user_migration auth.User accounts.MyUser "
+                   "--chunk-size=1000")
+
+    def check_verify_finds_differences(self):
+        user_id, membership_id = self.shell_output(
+            "./manage.py myproject_tamper_new_users").split()
+        process = subprocess.Popen(
+            "cd test_project; ./manage.py verify_custom_user_migration "
+            "auth.User accounts.MyUser", shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = [output.decode('utf-8') for output in process.communicate()]
+        self.assertNotEqual(process.returncode, 0)
+        self.assertIn("CommandError: Rows differ in accounts_myuser, accounts_myuser_groups",
+                      stderr)
+        self.assertIn("  changed ids: {0}\n".format(user_id), stdout)
+        self.assertIn("  missing ids: {0}\n".format(membership_id), stdout)
+
+    def check_populate_reversed(self):
+        # Reverse the populate migration on its own, and run it again
+        self.shell("./manage.py migrate --noinput accounts 0001")
+        self.shell("./manage.py myproject_test_populate_reversed")
+        self.shell("rm -f progress.log report.log")
+        self.shell("./manage.py migrate --noinput")
+
+    def set_report(self, report_path):
+        with change_file("test_project/myapp/settings.py") as f:
+            f.write(f.contents + "\nCUSTOM_USER_MIGRATION_REPORT = {0}\n".format(
+                repr(report_path)))
+
+    def check_report(self):
+        with open("test_project/report.log") as f:
+            records = [json.loads(line) for line in f]
+        phases = dict((r['phase'], r) for r in records)
+        self.assertEqual(sorted(phases), ["contenttypes", "empty", "populate", "schema"])
+        for record in records:
+            self.assertGreater(record['statements'], 0)
+            self.assertIsNone(record['error'])
+        altered = [step['table_name'] for step in phases['schema']['steps']]
+        self.assertIn("myapp_mymodel", altered)
+        self.assertEqual(phases['schema']['tables'], len(altered))
+        self.assertEqual(phases['schema']['alterations'],
+                         self.get_expected_alterations(phases['schema']))
+        self.check_populate_report([r for r in records if r['phase'] == "populate"])
+
+    def get_expected_alterations(self, record):
+        # Each table is altered once
+        return record['tables']
+
+    def check_populate_report(self, records):
+        # Two users, one of them in a group
+        rows = sum(r['rows'] for r in records)
+        if "--resumable" in self.populate_options:
+            # Writing checkpoints counts too
+            self.assertGreater(rows, 3)
+        else:
+            self.assertEqual(rows, 3)
+
+    def check_copied_functions(self):
+        # Every helper that the migrations use must be copied into them
+        def get_functions(path):
+            with open(path) as f:
+                tree = ast.parse(f.read())
+            return (set(node.name for node in tree.body if isinstance(node, ast.FunctionDef)),
+                    set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)))
+
+        helpers = get_functions("django_custom_user_migration/utils.py")[0]
+        for path in glob.glob("test_project/accounts/migrations/0*.py"):
+            defined, used = get_functions(path)
+            self.assertEqual(sorted((used & helpers) - defined), [], path)
+
+    def check_progress_log(self):
+        with open("test_project/progress.log") as f:
+            entries = [json.loads(line) for line in f]
+        copied = [e for e in entries if e['table_name'] == 'accounts_myuser']
+        self.assertEqual(copied[-1]['rows_copied'], 2)
+        self.assertEqual(copied[-1]['rows_remaining'], 0)
+
     def set_auth_user_model(self, model_path):
         with change_file("test_project/myapp/settings.py") as f:
             f.write(f.contents + "\nAUTH_USER_MODEL = {0}\n".format(repr(model_path)))
@@ -133,6 +265,88 @@ DATABASES = {
 }
 """)
 
+    def get_expected_alterations(self, record):
+        if django.VERSION >= (1, 11):
+            # Tables are rebuilt for each field
+            return record['foreign_keys']
+        return record['tables']
+
+
+class TestProcessSqliteServerCopy(TestProcessSqlite):
+
+    populate_options = "--copy-mode=server"
+
+
+class TestProcessSqliteSmallBatches(TestProcessSqlite):
+
+    populate_options = "--batch-size=1 --max-buffer-bytes=1"
+
+
+class TestProcessSqliteSmallBuffer(TestProcessSqlite):
+
+    # Fewer than --batch-size rows are fetched at a time
+    populate_options = "--max-buffer-bytes=1"
+
+
+class TestProcessSqliteResumable(TestProcessSqlite):
+
+    populate_options = "--resumable --batch-size=1"
+
+
+class TestProcessSqliteOnline(TestProcessSqlite):
+
+    def test_process(self):
+        # Not supported on SQLite
+        self.shell("./manage.py migrate")
+        self.add_to_installed_apps("django_custom_user_migration")
+        self.create_custom_user_model()
+        self.add_to_installed_apps("accounts")
+        self.shell("./manage.py makemigrations accounts")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.shell("./manage.py create_custom_user_populate_migration "
+                       "auth.User accounts.MyUser --online")
+
+
+class TestProcessSqliteFast(TestProcessSqlite):
+
+    populate_options = "--fast-sqlite"
+    schema_options = "--fast-sqlite"
+
+
+class TestProcessSqliteRenameTables(TestProcessSqlite):
+
+    # Falls back to copying
+    populate_options = "--rename-tables"
+
+
+class TestProcessSqliteChunkedEmpty(TestProcessSqlite):
+
+    populate_options = "--empty-mode=chunked --batch-size=1 --vacuum"
+
+
+class TestProcessSqliteDeferIndexes(TestProcessSqlite):
+
+    populate_options = "--defer-indexes"
+
+
+class TestProcessSqliteParallelSchema(TestProcessSqlite):
+
+    # Falls back to altering tables serially
+    schema_options = "--workers=3"
+
+
+class TestProcessSqliteCombined(TestProcessSqlite):
+
+    combined = True
+    populate_options = "--fast-sqlite"
+    schema_options = "--schema-fast-sqlite"
+
+
+class TestProcessSqliteParallel(TestProcessSqlite):
+
+    # Falls back to copying serially
+    populate_options = "--workers=3"
+
 
 class TestProcessPostgres(TestProcessBase, unittest.TestCase):
 
@@ -172,6 +386,120 @@ DATABASES = {
 """)
 
 
+class TestProcessPostgresCopy(TestProcessPostgres):
+
+    populate_options = "--copy-mode=copy --batch-size=1"
+
+
+class TestProcessPostgresSmallBuffer(TestProcessPostgres):
+
+    # Fewer than --batch-size rows are fetched at a time
+    populate_options = "--max-buffer-bytes=1"
+
+
+class TestProcessPostgresParallel(TestProcessPostgres):
+
+    populate_options = "--workers=3 --copy-mode=server"
+
+
+class TestProcessPostgresResumable(TestProcessPostgres):
+
+    populate_options = "--resumable --batch-size=1 --copy-mode=copy"
+
+
+class TestProcessPostgresOnline(TestProcessPostgres):
+
+    populate_options = "--online --batch-size=1"
+
+
+class TestProcessPostgresRenameTables(TestProcessPostgres):
+
+    populate_options = "--rename-tables"
+
+    def check_populated(self):
+        # The old tables are left empty
+        pass
+
+    def check_progress_log(self):
+        # Nothing is copied
+        pass
+
+    def check_populate_report(self, records):
+        pass
+
+    def check_verify_finds_differences(self):
+        # The old tables are left empty, so every row would differ
+        pass
+
+    def check_populate_reversed(self):
+        self.shell("./manage.py migrate --noinput accounts 0001")
+        self.shell("./manage.py myproject_test_swap_columns")
+        super(TestProcessPostgresRenameTables, self).check_populate_reversed()
+
+    def get_expected_alterations(self, record):
+        # The constraints already point to the new table, and are only renamed
+        return 0
+
+
+class TestProcessPostgresTruncate(TestProcessPostgres):
+
+    populate_options = "--empty-mode=truncate --vacuum"
+
+
+class TestProcessPostgresChunkedEmpty(TestProcessPostgres):
+
+    populate_options = "--empty-mode=chunked --batch-size=1"
+
+
+class TestProcessPostgresDeferIndexes(TestProcessPostgres):
+
+    populate_options = "--defer-indexes --copy-mode=copy"
+
+
+class TestProcessPostgresLowLock(TestProcessPostgres):
+
+    schema_options = "--low-lock"
+
+
+class TestProcessPostgresCrossDatabase(TestProcessPostgres):
+
+    # The new tables are written through another alias for the same database
+    populate_options = "--target-database=target"
+
+    def set_db(self):
+        super(TestProcessPostgresCrossDatabase, self).set_db()
+        with change_file("test_project/myapp/settings.py") as f:
+            f.write(f.contents + "\nDATABASES['target'] = dict(DATABASES['default'])\n")
+
+
+class TestProcessPostgresCrossDatabaseSource(TestProcessPostgres):
+
+    # The old tables are read through another alias for the same database
+    populate_options = "--source-database=source"
+
+    def set_db(self):
+        super(TestProcessPostgresCrossDatabaseSource, self).set_db()
+        with change_file("test_project/myapp/settings.py") as f:
+            f.write(f.contents + "\nDATABASES['source'] = dict(DATABASES['default'])\n")
+
+
+class TestProcessPostgresParallelSchema(TestProcessPostgres):
+
+    schema_options = "--workers=3"
+
+
+class TestProcessPostgresParallelLowLockSchema(TestProcessPostgres):
+
+    schema_options = "--workers=3 --low-lock"
+
+
+class TestProcessPostgresCombined(TestProcessPostgres):
+
+    combined = True
+    populate_options = "--copy-mode=server --workers=2"
+    schema_options = "--low-lock --schema-workers=3"
+
+
 class change_file(object):
     def __init__(self, filename):
         self.filename = filename
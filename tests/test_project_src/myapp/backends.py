@@ -0,0 +1,12 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+
+
+class AnyUserModelBackend(ModelBackend):
+    """
+    ModelBackend, but able to find the group permissions of users of a model
+    other than AUTH_USER_MODEL, such as the new user model before the switch.
+    """
+
+    def _get_group_permissions(self, user_obj):
+        return Permission.objects.filter(group__in=user_obj.groups.all())
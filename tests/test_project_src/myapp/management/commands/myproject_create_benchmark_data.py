@@ -0,0 +1,89 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from myapp.models import MyModel, OtherModel
+
+
+class Command(BaseCommand):
+    help = "Creates large amounts of data for benchmarking, using SQL for speed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--groups-per-user", type=int, default=3)
+        parser.add_argument("--permissions-per-user", type=int, default=1)
+        parser.add_argument("--owners-per-thing", type=int, default=10)
+
+    def handle(self, *args, **options):
+        users = options['users']
+        groups_per_user = options['groups_per_user']
+        owners_per_thing = options['owners_per_thing']
+        groups = max(groups_per_user, users // 100)
+        things = max(1, users // owners_per_thing)
+        permissions = Permission.objects.order_by('id').values_list('id', flat=True)
+        permissions_per_user = min(options['permissions_per_user'], len(permissions))
+        user_type = ContentType.objects.get_for_model(User)
+        now = timezone.now()
+
+        with transaction.atomic():
+            self.insert(User, ["id", "password", "is_superuser", "username", "first_name",
+                               "last_name", "email", "is_staff", "is_active", "date_joined"],
+                        "s.x, '!', %s, 'user' || s.x, 'First', 'Last', "
+                        "'user' || s.x || '@example.com', %s, %s, %s",
+                        [series(users, "s")], [False, False, True, now])
+            self.insert(Group, ["id", "name"],
+                        "s.x, 'group' || s.x",
+                        [series(groups, "s")])
+            self.insert(User.groups.through, ["user_id", "group_id"],
+                        "s.x, ((s.x + f.x) %% {0}) + 1".format(groups),
+                        [series(users, "s"), series(groups_per_user, "f")])
+            if permissions_per_user:
+                self.insert(User.user_permissions.through, ["user_id", "permission_id"],
+                            "s.x, {0} + ((s.x + f.x) %% {1})".format(permissions[0],
+                                                                    permissions_per_user),
+                            [series(users, "s"), series(permissions_per_user, "f")])
+            self.insert(MyModel, ["id", "name", "owner_id", "editor_id"],
+                        "s.x, 'My model', s.x, (s.x %% {0}) + 1".format(users),
+                        [series(users, "s")])
+            self.insert(OtherModel, ["id", "name"],
+                        "s.x, 'Some thing'",
+                        [series(things, "s")])
+            self.insert(OtherModel.owners.through, ["othermodel_id", "user_id"],
+                        "s.x, (((s.x - 1) * {0} + f.x - 1) %% {1}) + 1".format(
+                            owners_per_thing, users),
+                        [series(things, "s"), series(min(owners_per_thing, users), "f")])
+            self.insert(LogEntry, ["action_time", "user_id", "content_type_id", "object_id",
+                                   "object_repr", "action_flag", "change_message"],
+                        "%s, s.x, {0}, CAST((s.x %% {1}) + 1 AS TEXT), 'user', {2}, 'created'".format(
+                            user_type.id, users, ADDITION),
+                        [series(users, "s")], [now])
+
+            cursor = connection.cursor()
+            for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                         [User, Group, MyModel, OtherModel]):
+                cursor.execute(sql)
+
+        for model in [User, User.groups.through, User.user_permissions.through,
+                      MyModel, OtherModel, OtherModel.owners.through, LogEntry]:
+            self.stdout.write("{0} {1}".format(model._meta.db_table, model.objects.count()))
+
+    def insert(self, model, columns, select, sources, params=()):
+        sql = "INSERT INTO {0} ({1}) SELECT {2} FROM {3}".format(
+            model._meta.db_table, ", ".join(columns), select, ", ".join(sources))
+        connection.cursor().execute(sql, params)
+
+
+def series(count, alias):
+    """
+    Returns a FROM clause item with a column x numbering rows 1 to count
+    """
+    if connection.vendor == 'postgresql':
+        return "generate_series(1, {0}) AS {1}(x)".format(count, alias)
+    return ("(WITH RECURSIVE {1}(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM {1} WHERE x < {0}) "
+            "SELECT x FROM {1}) AS {1}".format(count, alias))
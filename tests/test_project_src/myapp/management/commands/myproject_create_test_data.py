@@ -16,7 +16,8 @@ class Command(BaseCommand):
 
         user1.groups.add(group1)
 
-        MyModel.objects.create(name="My model", owner=user1)
+        # reviewer has no FK constraint, and points to a user that doesn't exist
+        MyModel.objects.create(name="My model", owner=user1, editor=user2, reviewer_id=999)
 
         # Create a dummy log entry for a change on user2, by user1
         LogEntry.objects.log_action(
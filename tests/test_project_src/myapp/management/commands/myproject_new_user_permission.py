@@ -0,0 +1,25 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.contrib.auth.models import Group, Permission
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Gives 'Test Group' a permission of the new user model, which is created "
+            "by running the populate migration on its own, or checks it still has it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", default=False)
+
+    def handle(self, *args, **options):
+        group = Group.objects.get(name="Test Group")
+        if options['check']:
+            permissions = group.permissions.filter(content_type__app_label="accounts",
+                                                   content_type__model="myuser",
+                                                   codename="add_myuser")
+            if len(permissions) != 1:
+                raise AssertionError("Permission for new user model not kept")
+        else:
+            group.permissions.add(Permission.objects.get(content_type__app_label="accounts",
+                                                         content_type__model="myuser",
+                                                         codename="add_myuser"))
@@ -0,0 +1,18 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import MyUser as NewUser
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **kwargs):
+        # Makes the new tables differ from the old ones after the populate
+        # migration, for verify_custom_user_migration to find. Writes the ids
+        # of the changed user and of the deleted M2M row.
+        user = NewUser.objects.get(username="testuser")
+        NewUser.objects.filter(id=user.id).update(email="tampered@user.com")
+        membership = NewUser.groups.through.objects.filter(myuser=user).first()
+        NewUser.groups.through.objects.filter(id=membership.id).delete()
+        self.stdout.write("{0} {1}".format(user.id, membership.id))
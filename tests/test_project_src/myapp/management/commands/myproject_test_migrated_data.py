@@ -33,6 +33,10 @@ class Command(BaseCommand):
         mymodel = MyModel.objects.get(name="My model")
         if mymodel.owner != user1:
             raise AssertionError("MyModel.owner not pointing to right object")
+        if mymodel.editor != user2:
+            raise AssertionError("MyModel.editor not pointing to right object")
+        if mymodel.reviewer_id != 999:
+            raise AssertionError("MyModel.reviewer_id changed")
 
         log_entries = user1.logentry_set.all()
         if len(log_entries) != 1:
@@ -0,0 +1,59 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.contrib.auth.models import Permission
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from accounts.models import MyUser as NewUser
+
+
+class Command(BaseCommand):
+    help = ("Checks that the new user model answers permission checks from its "
+            "cache, and can prefetch permissions. Run after myproject_new_user_permission.")
+
+    @override_settings(AUTHENTICATION_BACKENDS=['myapp.backends.AnyUserModelBackend'])
+    def handle(self, *args, **options):
+        user = NewUser.objects.get(username="testuser")
+        if not user.has_perm("accounts.add_myuser"):
+            raise AssertionError("Group permission not found")
+        if user.get_permission_cache() != frozenset(["accounts.add_myuser"]):
+            raise AssertionError("Unexpected permission cache {0!r}".format(
+                user.get_permission_cache()))
+
+        with CaptureQueriesContext(connection) as queries:
+            if not user.has_perms(["accounts.add_myuser"]):
+                raise AssertionError("has_perms doesn't agree with has_perm")
+            if not user.has_module_perms("accounts"):
+                raise AssertionError("Module permission not found")
+            if user.has_perm("auth.add_group") or user.has_module_perms("auth"):
+                raise AssertionError("Unexpected permission found")
+        if len(queries) > 0:
+            raise AssertionError("Permissions not cached: {0}".format(queries.captured_queries))
+
+        permission = Permission.objects.get(content_type__app_label="auth", codename="add_group")
+        user.user_permissions.add(permission)
+        try:
+            if user.has_perm("auth.add_group"):
+                raise AssertionError("Permissions changed without clearing the cache")
+            user.clear_permission_cache()
+            if not user.has_perm("auth.add_group"):
+                raise AssertionError("Permission cache not cleared")
+        finally:
+            user.user_permissions.remove(permission)
+
+        with CaptureQueriesContext(connection) as queries:
+            users = list(NewUser.objects.prefetch_permissions().filter(is_active=True))
+        if len(queries) != 4:
+            raise AssertionError("Unexpected queries: {0}".format(queries.captured_queries))
+        with CaptureQueriesContext(connection) as queries:
+            for user in users:
+                has_perm = user.has_perm("accounts.add_myuser")
+                if has_perm != (user.username == "testuser"):
+                    raise AssertionError("Unexpected has_perm for {0}".format(user.username))
+                if user.get_group_permissions() != set(["accounts.add_myuser"] if has_perm else []):
+                    raise AssertionError("Unexpected group permissions for {0}".format(
+                        user.username))
+        if len(queries) > 0:
+            raise AssertionError("Permissions not prefetched: {0}".format(
+                queries.captured_queries))
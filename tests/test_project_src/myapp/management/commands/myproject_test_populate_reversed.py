@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from accounts.models import MyUser as NewUser
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **kwargs):
+        # After reversing the populate migration on its own, the users should
+        # be back in the old tables, and the new tables should be empty.
+        user1 = User.objects.get(username="testuser")
+        User.objects.get(username="otheruser")
+        if user1.email != "test@user.com":
+            raise AssertionError("user testuser doesn't have expected email address")
+
+        if "Test Group" not in [g.name for g in user1.groups.all()]:
+            raise AssertionError("user testuser doesn't have expected 'Test Group' in groups")
+
+        if NewUser.objects.exists():
+            raise AssertionError("{0} table not emptied".format(NewUser._meta.db_table))
+        if NewUser.groups.through.objects.exists():
+            raise AssertionError("{0} table not emptied".format(
+                NewUser.groups.through._meta.db_table))
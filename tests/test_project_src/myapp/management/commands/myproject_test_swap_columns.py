@@ -0,0 +1,27 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from django_custom_user_migration.utils import swap_table_names
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **kwargs):
+        # Tables whose columns differ must not be swapped. The new M2M table
+        # is given an extra column, which is rolled back afterwards.
+        with transaction.atomic():
+            with connection.schema_editor() as editor:
+                editor.execute("ALTER TABLE accounts_myuser_groups ADD COLUMN extra integer;")
+                try:
+                    swap_table_names(apps, editor, [("auth", "User", "accounts", "MyUser"),
+                                                    ("auth", "User_groups",
+                                                     "accounts", "MyUser_groups")])
+                except RuntimeError as e:
+                    if "because their columns differ" not in str(e):
+                        raise
+                else:
+                    raise AssertionError("Swapped tables with different columns")
+            transaction.set_rollback(True)
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('myapp', '0002_othermodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mymodel',
+            name='editor',
+            field=models.ForeignKey(related_name='+', to=settings.AUTH_USER_MODEL, null=True),
+        ),
+    ]
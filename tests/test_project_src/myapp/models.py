@@ -8,6 +8,9 @@ from django.conf import settings
 class MyModel(models.Model):
     name = models.CharField(max_length=255)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL)
+    editor = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='+')
+    reviewer = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='+',
+                                 db_constraint=False)
 
 
 class OtherModel(models.Model):
@@ -0,0 +1,6 @@
+import json
+
+
+def record_progress(**kwargs):
+    with open("progress.log", "a") as f:
+        f.write(json.dumps(kwargs) + "\n")